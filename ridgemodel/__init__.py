@@ -25,4 +25,6 @@ from .io import *
 from .plots import *
 from .design import *
 from .ridge import *
+from .shared import *
+from .profiling import *
 
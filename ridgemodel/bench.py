@@ -0,0 +1,243 @@
+# MIT License
+
+# Copyright (c) 2019 Churchland laboratory
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import platform
+import scipy
+
+from .utils import *
+from .ridge import ridge_MML
+from .design import make_design_matrix, calc_regressor_orthogonality
+from .profiling import PeakMemory
+
+
+def make_synthetic_design(frames, regressors, components, kernel_len = 30, event_rate = 0.01, noise = 1, seed = 0):
+    '''
+    Generates a binary design matrix made of lagged event trains (kernel_len
+    lags per event type, as built by make_design_matrix) and temporal
+    components that are a noisy linear function of it.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    n_events = int(np.ceil(regressors / kernel_len))
+    trains = rng.random((frames, n_events)) < event_rate # zero lag regressors
+
+    R = np.zeros((frames, n_events * kernel_len))
+    for i_lag in range(kernel_len):
+        R[i_lag:, i_lag::kernel_len] = trains[:frames - i_lag]
+    R = R[:, :regressors]
+
+    beta = rng.standard_normal((regressors, components)) / np.sqrt(regressors)
+    SVT = (R @ beta + noise * rng.standard_normal((frames, components))).T
+
+    return R, SVT
+
+
+def bench_beta_solve(frames = 30000, regressors = 2000, components = 300, repeats = 1, seed = 0):
+    '''
+    Compares the SVD beta solve of ridge_MML with the per-column
+    ("conservative") solve on a synthetic design matrix, with the lambdas
+    fixed so only the solve is timed. Returns the best time of each path and
+    the largest difference between their betas.
+    '''
+
+    R, SVT = make_synthetic_design(frames, regressors, components, seed = seed)
+    L = np.logspace(-1, 3, components)
+
+    times = {}
+    betas = {}
+    for conservative in [False, True]:
+        c_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            betas[conservative] = ridge_MML(SVT.T, R, L = L, conservative = conservative)
+            c_times.append(time.perf_counter() - start)
+        times['conservative' if conservative else 'svd'] = min(c_times)
+
+    return {'frames': frames, 'regressors': regressors, 'components': components,
+            'svd': times['svd'], 'conservative': times['conservative'],
+            'max_abs_diff': float(np.max(np.abs(betas[False] - betas[True])))}
+
+
+def make_synthetic_session(frames = 20000, height = 128, width = 128, components = 200, regressors = 500, trial_frames = 90, event_rate = 0.5, seed = 0):
+
+    '''
+    Generates a widefield-like session with the layout of a session folder:
+    events (post-event and peri-event types, about `regressors` design
+    matrix columns in total), trial onsets, options and U (height x width x
+    components, NaN outside an elliptical brain mask) and SVT (components x
+    frames), with SVT a noisy linear function of the design matrix.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    opts = {'s_post_time': 1, 'm_pre_time': 0.5, 'm_post_time': 1, 'n_folds': 10, 'fs': 30}
+    trial_onsets = np.arange(0, frames, trial_frames)
+    trial_onsets = np.append(trial_onsets, frames)
+
+    event_types, event_frames, event_labels = [], [], []
+    n_lags = {2: int(np.ceil(opts['s_post_time'] * opts['fs'])), 3: int(np.ceil(opts['m_pre_time'] * opts['fs']) + np.ceil(opts['m_post_time'] * opts['fs']))}
+    n_cols = 0
+    while n_cols < regressors:
+        event_type = 2 + len(event_types) % 2
+        n_events = rng.binomial(len(trial_onsets) - 1, event_rate)
+        c_trials = np.sort(rng.choice(len(trial_onsets) - 1, n_events, replace=False))
+        event_frames.append(trial_onsets[c_trials] + rng.integers(0, trial_frames // 2, n_events)) # at most one event per trial
+        event_types.append(event_type)
+        event_labels.append(f'event_{len(event_labels)}')
+        n_cols += n_lags[event_type]
+
+    R, _ = make_design_matrix(event_frames, np.array(event_types), trial_onsets, opts)
+    beta = rng.standard_normal((np.size(R,1), components)).astype(np.float32) / np.sqrt(np.size(R,1))
+    SVT = (R @ beta + rng.standard_normal((frames, components), dtype=np.float32)).T
+
+    U = rng.standard_normal((height, width, components), dtype=np.float32) / np.sqrt(components)
+    y, x = np.ogrid[:height, :width]
+    U[((y - height / 2) / (height / 2)) ** 2 + ((x - width / 2) / (width / 2)) ** 2 > 1] = np.nan
+
+    return {'event_frames': event_frames, 'event_types': np.array(event_types), 'event_labels': np.array(event_labels),
+            'trial_onsets': trial_onsets, 'opts': opts, 'U': U, 'SVT': SVT}
+
+
+def save_synthetic_session(localdisk, session):
+    # write a synthetic session in the layout read by the command line interface
+
+    os.makedirs(localdisk, exist_ok=True)
+    events = np.zeros(len(session['event_types']), dtype=[('label', '<U30'), ('type', 'u1'), ('iframes', 'O')])
+    events['label'] = session['event_labels']
+    events['type'] = session['event_types']
+    for i_event, c_frames in enumerate(session['event_frames']):
+        events[i_event]['iframes'] = c_frames
+    np.save(pjoin(localdisk, 'events.npy'), events)
+
+    onsets = np.zeros(len(session['trial_onsets']) - 1, dtype=[('itrial', '<i4'), ('iframe', '<i4')])
+    onsets['itrial'] = np.arange(len(onsets))
+    onsets['iframe'] = session['trial_onsets'][:-1]
+    np.save(pjoin(localdisk, 'trial_onsets.npy'), onsets)
+
+    with open(pjoin(localdisk, 'opts.json'), 'w') as opts_f:
+        json.dump(session['opts'], opts_f, indent=4)
+    np.save(pjoin(localdisk, 'SVTcorr.npy'), session['SVT'])
+    np.save(pjoin(localdisk, 'SVTcorr_wfield.npy'), session['SVT'])
+    np.save(pjoin(localdisk, 'U_wfield.npy'), session['U'])
+
+
+def time_stage(func, repeats = 3):
+    # wall and CPU times of every run of func and the peak memory over all runs; returns them with the last result
+
+    wall, cpu = [], []
+    with PeakMemory() as memory:
+        for _ in range(repeats):
+            start, start_cpu = time.perf_counter(), time.process_time()
+            result = func()
+            wall.append(time.perf_counter() - start)
+            cpu.append(time.process_time() - start_cpu)
+
+    return {'wall': wall, 'cpu': cpu, 'wall_median': float(np.median(wall)), 'wall_min': float(np.min(wall)), 'cpu_median': float(np.median(cpu)),
+            'peak_rss_mb': memory.peak / 2**20, 'rss_increase_mb': (memory.peak - memory.baseline) / 2**20}, result
+
+
+def environment():
+    # versions and hardware, to tell apart reports from different setups
+    env = {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+           'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+    try:
+        env['blas'] = np.show_config(mode='dicts')['Build Dependencies']['blas'].get('name')
+    except Exception:
+        env['blas'] = None
+    return env
+
+
+def run_benchmark(frames = 20000, height = 128, width = 128, components = 200, regressors = 500, repeats = 3, folds = 10, seed = 0):
+
+    '''
+    Times the stages of the pipeline on a synthetic session (see
+    make_synthetic_session): make_design_matrix, calc_regressor_orthogonality,
+    ridge_MML, cross_val_model and model_corr. Every stage is run `repeats`
+    times; the report has the wall and CPU times of each run, their medians,
+    the peak resident memory and the throughput (frames or pixels per second
+    of the median run), with the parameters and the environment, so two
+    reports can be compared with compare_reports.
+    '''
+
+    session = make_synthetic_session(frames, height, width, components, regressors, seed = seed)
+    event_frames, event_types, event_labels = session['event_frames'], session['event_types'], session['event_labels']
+    trial_onsets, opts = session['trial_onsets'], session['opts']
+    r_stack = SVDStack(session['U'], session['SVT'])
+    pixels = int(np.sum(~r_stack.mask))
+
+    stages = {}
+
+    stages['make_design_matrix'], (R, event_idx) = time_stage(lambda: make_design_matrix(event_frames, event_types, trial_onsets, opts), repeats)
+    stages['make_design_matrix']['throughput'], stages['make_design_matrix']['unit'] = frames, 'frames/s'
+
+    stages['calc_regressor_orthogonality'], (_, R, event_idx) = time_stage(lambda: calc_regressor_orthogonality(R, event_idx), repeats)
+    stages['calc_regressor_orthogonality']['throughput'], stages['calc_regressor_orthogonality']['unit'] = frames, 'frames/s'
+
+    stages['ridge_MML'], _ = time_stage(lambda: ridge_MML(r_stack.SVT.T, R, display_failures = False), repeats)
+    stages['ridge_MML']['throughput'], stages['ridge_MML']['unit'] = frames, 'frames/s'
+
+    stages['cross_val_model'], (m_stack, *_) = time_stage(lambda: cross_val_model(R, r_stack, event_labels, event_idx, event_labels, folds, suppress_output = True), repeats)
+    stages['cross_val_model']['throughput'], stages['cross_val_model']['unit'] = frames, 'frames/s'
+
+    stages['model_corr'], _ = time_stage(lambda: model_corr(r_stack, m_stack), repeats)
+    stages['model_corr']['throughput'], stages['model_corr']['unit'] = pixels, 'pixels/s'
+
+    for stage in stages.values():
+        stage['throughput'] = stage['throughput'] / stage['wall_median']
+
+    return {'schema': 1, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'environment': environment(),
+            'params': {'frames': frames, 'height': height, 'width': width, 'pixels': pixels, 'components': components,
+                       'regressors': int(np.size(R,1)), 'repeats': repeats, 'folds': folds, 'seed': seed},
+            'stages': stages}
+
+
+def compare_reports(base, new, tolerance = 0.1, min_time = 0.05):
+
+    '''
+    Compares the median wall time and peak memory of every stage in two
+    reports of run_benchmark. A ratio above 1 means that new is slower (or
+    uses more memory). Stages slower by more than tolerance are flagged as
+    regressions, unless they take less than min_time seconds in both
+    reports, where timings are mostly noise. Reports made with different
+    parameters are not comparable and raise a ValueError.
+    '''
+
+    if base['params'] != new['params']:
+        raise ValueError('The reports were made with different parameters and can not be compared.')
+
+    comparison = {}
+    for name in base['stages']:
+        if name not in new['stages']:
+            continue
+        base_time, new_time = base['stages'][name]['wall_median'], new['stages'][name]['wall_median']
+        ratio = new_time / base_time
+        comparison[name] = {'base': base_time, 'new': new_time, 'time_ratio': ratio,
+                            'memory_ratio': new['stages'][name]['peak_rss_mb'] / base['stages'][name]['peak_rss_mb'],
+                            'regression': ratio > 1 + tolerance and max(base_time, new_time) >= min_time}
+
+    return comparison
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench_beta_solve(), indent=2))
@@ -22,12 +22,27 @@
 
 from .utils import *
 from .design import make_design_matrix, calc_regressor_orthogonality
-from .utils import cross_val_model, model_corr
-from .io import load_stack
+from .utils import blas_env, limit_cpus, cross_val_model, cross_val_models, cross_val_unique, regressor_subset, model_corr, parcel_corr
+from .io import load_stack, load_opts, pack_design, unpack_design, Manifest
 from .plots import plot_regressor_orthogonality, plot_model_corr
+from .bench import run_benchmark, compare_reports
+from .profiling import Profiler, stage, profiled, merge_report
 
 import argparse
 import sys
+import time
+import traceback
+import contextlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+def _profile_parser():
+    # the --profile option of every command
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--profile', action='store', metavar='OUT.json',
+                    default=None, type=str, help='Record the time, memory and call counts of every stage to a JSON file. Under batch, the stages of all the sessions are added up.')
+    return parser
+
 
 class CLIParser(object):
     def __init__(self):
@@ -39,6 +54,12 @@ The commands are:
     process             Performs ridge regression on widefield imaging data using events as regressors
     design              Builds a design matrix from events (output: design.npz)
     cross_val           Performs cross-validated ridge-regression on widefield imaging data (output: (reg)-m.npz, for each regressor)
+    unique              Computes the unique contribution (delta R^2) of each regressor (output: unique.npz)
+    batch               Runs process on several session folders in parallel worker processes
+    bench               Times the pipeline stages on a synthetic session (output: JSON report)
+
+Any command also takes --profile <out.json>, to record the time, memory and call counts of every stage.
+Under batch, the profiles of the worker processes are added up.
 ''')
         parser.add_argument('command', help='type ridgemodel <command> -h for help')
 
@@ -47,25 +68,70 @@ The commands are:
             print('Command {0} not recognized.'.format(args.command))
             parser.print_help()
             exit(1) 
-        getattr(self, args.command)()
+
+        # --profile is shared by all commands, so it is taken out before the command parses its arguments
+        profile_parser = _profile_parser()
+        profile_parser.prog = f'ridgemodel {args.command}'
+        profile_args, sys.argv[2:] = profile_parser.parse_known_args(sys.argv[2:])
+        self.profile = profile = profile_args.profile
+
+        if profile is None:
+            getattr(self, args.command)()
+            return
+
+        prof = Profiler()
+        try:
+            with prof:
+                getattr(self, args.command)()
+        finally: # also when the command exits early or fails
+            prof.save(profile)
+            print(f'Profile saved to {profile}')
         
         
     def process(self):    
         parser = argparse.ArgumentParser(
-        description='Performs ridge regression on widefield imaging data using events as regressors')
+        description='Performs ridge regression on widefield imaging data using events as regressors', parents=[_profile_parser()])
         parser.add_argument('foldername', action='store',
                     default=None, type=str,
                     help='Folder where to search for events, trial onsets, options, and imaging files (U and STV) files')  
         parser.add_argument('-r', '--regressors', nargs='+', action='store',
                     default=['full'], type=str,
                     help='Regressors or regressor categories to use. \'full\' will use all regressors, \'task\' will use only task regressors (event IDs 1 and 2), and \'move\' will use only movement regressors (event ID 3)')
+        parser.add_argument('--gram', action='store_true',
+                    default=False, help='Fit the cross-validation folds from cross products computed in one pass over the data.')
+        parser.add_argument('-j', '--n_jobs', action='store',
+                    default=1, type=int, help='Number of threads to fit cross-validation folds in parallel.')
+        parser.add_argument('--mmap', action='store_true',
+                    default=False, help='Memory-map the imaging files instead of reading them into memory.')
+        parser.add_argument('--parcels', action='store',
+                    default=None, type=str, help='Label image (.npy, aligned to U, 0 outside parcels) to also compute the cvR^2 of each area.')
         parser.add_argument('--remove_redundant', action='store_true',
                     default=True, help='Automatically remove any redundant regressors.')   
+        parser.add_argument('--sparse', action='store_true',
+                    default=False, help='Build and store the design matrix as a sparse matrix.')
+        parser.add_argument('--pivot', action='store_true',
+                    default=False, help='Find redundant regressors with a column-pivoted (rank-revealing) QR and report the condition number.')
+        parser.add_argument('--tol', action='store',
+                    default=None, type=float, help='Relative rank tolerance of --pivot: regressors with |R_ii| / |R_00| below it are dropped (default 1e-6, which also drops near duplicates).')
+        parser.add_argument('--force', action='store_true',
+                    default=False, help='Recompute every stage, even if its inputs did not change since the last run.')
+        parser.add_argument('--checkpoint', action='store_true',
+                    default=False, help='Save every cross-validation fold as it completes, to resume an interrupted fit. Cannot be used with --gram.')
 
         args = parser.parse_args(sys.argv[2:])                     
+        if args.tol is not None and not args.pivot:
+            parser.error('--tol needs --pivot')
+        if args.gram and args.checkpoint:
+            parser.error('--checkpoint cannot be used with --gram')
         localdisk = args.foldername
         remove_redundant = args.remove_redundant
+        sparse = args.sparse
+        pivot = args.pivot
         regressors = args.regressors  
+        gram = args.gram
+        n_jobs = args.n_jobs
+        mmap = args.mmap
+        parcels = args.parcels
         
         if localdisk is None:
             print('Specify a fast local disk.')
@@ -74,22 +140,35 @@ The commands are:
             os.makedirs(localdisk)
             print(f'Created {localdisk}')       
                
-        _design(localdisk, remove_redundant) # build design matrix
+        _design(localdisk, remove_redundant, sparse, pivot, args.force, args.tol) # build design matrix
         
-        _cross_val(localdisk, regressors) # perform cross-validation
+        _cross_val(localdisk, regressors, gram, n_jobs, mmap, parcels, args.force, args.checkpoint) # perform cross-validation
         
     def design(self):     
         parser = argparse.ArgumentParser(
-        description='Builds a design matrix out of events')
+        description='Builds a design matrix out of events', parents=[_profile_parser()])
         parser.add_argument('foldername', action='store',
                             default=None, type=str,
                             help='Folder where to search for events, trial onsets, and options files')         
         parser.add_argument('--remove_redundant', action='store_true',
                             default=True, help='Automatically remove any redundant regressors.')   
+        parser.add_argument('--sparse', action='store_true',
+                            default=False, help='Build and store the design matrix as a sparse matrix.')
+        parser.add_argument('--pivot', action='store_true',
+                            default=False, help='Find redundant regressors with a column-pivoted (rank-revealing) QR and report the condition number.')
+        parser.add_argument('--tol', action='store',
+                            default=None, type=float, help='Relative rank tolerance of --pivot: regressors with |R_ii| / |R_00| below it are dropped (default 1e-6, which also drops near duplicates).')
+                            
+        parser.add_argument('--force', action='store_true',
+                    default=False, help='Recompute every stage, even if its inputs did not change since the last run.')
                             
         args = parser.parse_args(sys.argv[2:])                     
+        if args.tol is not None and not args.pivot:
+            parser.error('--tol needs --pivot')
         localdisk = args.foldername
         remove_redundant = args.remove_redundant
+        sparse = args.sparse
+        pivot = args.pivot
 
         if localdisk is None:
             print('Specify a fast local disk.')
@@ -98,21 +177,39 @@ The commands are:
             os.makedirs(localdisk)
             print(f'Created {localdisk}')       
             
-        _design(localdisk, remove_redundant)                    
+        _design(localdisk, remove_redundant, sparse, pivot, args.force, args.tol)
                             
     def cross_val(self):     
         parser = argparse.ArgumentParser(
-        description='Performs cross-validated ridge regression')
+        description='Performs cross-validated ridge regression', parents=[_profile_parser()])
         parser.add_argument('foldername', action='store',
                     default=None, type=str,
                     help='Folder where to search for design matrix, options, and imaging files (U and STV)')     
         parser.add_argument('-r', '--regressors', nargs='+', action='store',
                     default=['full'], type=str,
                     help='Regressors or regressor categories to use. \'full\' will use all regressors, \'task\' will use only task regressors (event IDs 1 and 2), and \'move\' will use only movement regressors (event ID 3)')
+        parser.add_argument('--gram', action='store_true',
+                    default=False, help='Fit the cross-validation folds from cross products computed in one pass over the data.')
+        parser.add_argument('-j', '--n_jobs', action='store',
+                    default=1, type=int, help='Number of threads to fit cross-validation folds in parallel.')
+        parser.add_argument('--mmap', action='store_true',
+                    default=False, help='Memory-map the imaging files instead of reading them into memory.')
+        parser.add_argument('--parcels', action='store',
+                    default=None, type=str, help='Label image (.npy, aligned to U, 0 outside parcels) to also compute the cvR^2 of each area.')
+        parser.add_argument('--force', action='store_true',
+                    default=False, help='Recompute every stage, even if its inputs did not change since the last run.')
+        parser.add_argument('--checkpoint', action='store_true',
+                    default=False, help='Save every cross-validation fold as it completes, to resume an interrupted fit. Cannot be used with --gram.')
 
         args = parser.parse_args(sys.argv[2:])
+        if args.gram and args.checkpoint:
+            parser.error('--checkpoint cannot be used with --gram')
         localdisk = args.foldername
         regressors = args.regressors
+        gram = args.gram
+        n_jobs = args.n_jobs
+        mmap = args.mmap
+        parcels = args.parcels
                     
         if localdisk is None:
             print('Specify a fast local disk.')
@@ -121,20 +218,189 @@ The commands are:
             os.makedirs(localdisk)
             print(f'Created {localdisk}')          
             
-        _cross_val(localdisk, regressors)                    
+        _cross_val(localdisk, regressors, gram, n_jobs, mmap, parcels, args.force, args.checkpoint)
+
+    def unique(self):
+        parser = argparse.ArgumentParser(
+        description='Computes the unique contribution (delta R^2) of each regressor, by leaving it out of the full model', parents=[_profile_parser()])
+        parser.add_argument('foldername', action='store',
+                    default=None, type=str,
+                    help='Folder where to search for design matrix, options, and imaging files (U and STV)')
+        parser.add_argument('--mmap', action='store_true',
+                    default=False, help='Memory-map the imaging files instead of reading them into memory.')
+
+        args = parser.parse_args(sys.argv[2:])
+        localdisk = args.foldername
+        mmap = args.mmap
+
+        if localdisk is None:
+            print('Specify a fast local disk.')
+            exit(1)
+        if not os.path.isdir(localdisk):
+            os.makedirs(localdisk)
+            print(f'Created {localdisk}')
+
+        _unique(localdisk, mmap)
+
+    def batch(self):
+        parser = argparse.ArgumentParser(
+        description='Runs process (design matrix and cross-validation) on several session folders, in parallel worker processes', parents=[_profile_parser()])
+        parser.add_argument('foldernames', nargs='+', action='store',
+                    type=str, help='Session folders, or glob patterns of session folders')
+        parser.add_argument('-p', '--processes', action='store',
+                    default=1, type=int, help='Number of sessions to run in parallel. Each session uses an equal share of the CPUs.')
+        parser.add_argument('-r', '--regressors', nargs='+', action='store',
+                    default=['full'], type=str,
+                    help='Regressors or regressor categories to use. \'full\' will use all regressors, \'task\' will use only task regressors (event IDs 1 and 2), and \'move\' will use only movement regressors (event ID 3)')
+        parser.add_argument('--gram', action='store_true',
+                    default=False, help='Fit the cross-validation folds from cross products computed in one pass over the data.')
+        parser.add_argument('-j', '--n_jobs', action='store',
+                    default=1, type=int, help='Number of threads to fit cross-validation folds in parallel, in each session.')
+        parser.add_argument('--mmap', action='store_true',
+                    default=False, help='Memory-map the imaging files instead of reading them into memory.')
+        parser.add_argument('--parcels', action='store',
+                    default=None, type=str, help='Label image (.npy, aligned to U, 0 outside parcels) to also compute the cvR^2 of each area.')
+        parser.add_argument('--sparse', action='store_true',
+                    default=False, help='Build and store the design matrix as a sparse matrix.')
+        parser.add_argument('--pivot', action='store_true',
+                    default=False, help='Find redundant regressors with a column-pivoted (rank-revealing) QR and report the condition number.')
+        parser.add_argument('--tol', action='store',
+                    default=None, type=float, help='Relative rank tolerance of --pivot: regressors with |R_ii| / |R_00| below it are dropped (default 1e-6, which also drops near duplicates).')
+        parser.add_argument('--status', action='store',
+                    default=None, type=str, help='JSON file to write the status of every session to.')
+        parser.add_argument('--force', action='store_true',
+                    default=False, help='Recompute every stage, even if its inputs did not change since the last run.')
+        parser.add_argument('--checkpoint', action='store_true',
+                    default=False, help='Save every cross-validation fold as it completes, to resume an interrupted fit. Cannot be used with --gram.')
+
+        args = parser.parse_args(sys.argv[2:])
+        if args.tol is not None and not args.pivot:
+            parser.error('--tol needs --pivot')
+        if args.gram and args.checkpoint:
+            parser.error('--checkpoint cannot be used with --gram')
+
+        sessions = []
+        for pattern in args.foldernames:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            sessions += [folder for folder in matches if os.path.isdir(folder) and folder not in sessions]
+        if not sessions:
+            print('No session folders found.')
+            exit(1)
+
+        options = {'rmv': True, 'sparse': args.sparse, 'pivot': args.pivot, 'tol': args.tol, 'regressors': args.regressors,
+                   'gram': args.gram, 'n_jobs': args.n_jobs, 'mmap': args.mmap, 'parcels': args.parcels, 'force': args.force, 'checkpoint': args.checkpoint,
+                   'profile': self.profile is not None}
+        status = _batch(sessions, options, args.processes)
+
+        if args.status is not None:
+            with open(args.status, 'w') as status_f:
+                json.dump(status, status_f, indent=2)
+        if any(c_status['status'] != 'done' for c_status in status.values()):
+            exit(1)
+
+
+    def bench(self):
+        parser = argparse.ArgumentParser(
+        description='Times the stages of the pipeline on a synthetic session and writes a JSON report', parents=[_profile_parser()])
+        parser.add_argument('-o', '--out', action='store',
+                    default='bench.json', type=str, help='JSON file to write the report to.')
+        parser.add_argument('--compare', action='store',
+                    default=None, type=str, help='Earlier report to compare the timings with.')
+        parser.add_argument('--tolerance', action='store', default=0.1, type=float,
+                    help='Relative slowdown of a stage that counts as a regression in --compare.')
+        parser.add_argument('--min_time', action='store', default=0.05, type=float,
+                    help='Stages faster than this (in seconds, in both reports) are never counted as regressions in --compare.')
+        parser.add_argument('--frames', action='store', default=20000, type=int, help='Number of frames.')
+        parser.add_argument('--height', action='store', default=128, type=int, help='Image height in pixels.')
+        parser.add_argument('--width', action='store', default=128, type=int, help='Image width in pixels.')
+        parser.add_argument('--components', action='store', default=200, type=int, help='Number of SVD components.')
+        parser.add_argument('--regressors', action='store', default=500, type=int, help='Approximate number of design matrix columns.')
+        parser.add_argument('--repeats', action='store', default=3, type=int, help='Number of runs of each stage.')
+        parser.add_argument('--seed', action='store', default=0, type=int, help='Seed of the synthetic session.')
+
+        args = parser.parse_args(sys.argv[2:])
+
+        report = run_benchmark(args.frames, args.height, args.width, args.components, args.regressors, args.repeats, seed = args.seed)
+        with open(args.out, 'w') as report_f:
+            json.dump(report, report_f, indent=2)
+
+        for name, c_stage in report['stages'].items():
+            print(f'{name:30s} {c_stage["wall_median"]:9.3f} s  {c_stage["peak_rss_mb"]:9.1f} MB  {c_stage["throughput"]:12.1f} {c_stage["unit"]}')
+
+        if args.compare is not None:
+            with open(args.compare, 'r') as base_f:
+                base = json.load(base_f)
+            try:
+                comparison = compare_reports(base, report, args.tolerance, args.min_time)
+            except ValueError as err:
+                print(f'Can not compare with {args.compare}: {err}')
+                print(f'Parameters of {args.compare}: {base["params"]}')
+                exit(1)
+            for name, c_comparison in comparison.items():
+                print(f'{name:30s} {c_comparison["time_ratio"]:6.2f}x time  {c_comparison["memory_ratio"]:6.2f}x memory' + ('  REGRESSION' if c_comparison['regression'] else ''))
+            if any(c_comparison['regression'] for c_comparison in comparison.values()):
+                exit(1)
+
 
                                   
-def _cross_val(localdisk, regressors):
-    
+@profiled('load')
+def _load_design(localdisk):
+
     fname = pjoin(localdisk,'design.npz')
     if os.path.isfile(fname):                               
         with np.load(fname) as design_f: # load design matrix, event IDs, event labels, and event types
-            full_R = design_f['full_R']
+            full_R = unpack_design(design_f)
             event_idx = design_f['event_idx']
             event_labels = design_f['event_labels']
             event_types = design_f['event_types']
     else:
         raise OSError('Could not find design.npz')   
+
+    return full_R, event_idx, event_labels, event_types
+
+
+def _unique(localdisk, mmap = False):
+
+    full_R, event_idx, event_labels, _ = _load_design(localdisk)
+    opts = load_opts(localdisk)
+    with stage('load'):
+        r_stack = load_stack(localdisk, 'r' if mmap else None) # load image stock
+
+    cvR2, dR2, labels, ridge, _ = cross_val_unique(full_R, r_stack, event_idx, event_labels, opts['n_folds'])
+
+    with stage('save'):
+        np.savez(pjoin(localdisk, 'unique'), cvR2=cvR2, dR2=dR2, labels=labels, ridge=ridge) # save the results
+
+    # output pdf of the unique contribution of each regressor
+    for label, c_dR2 in zip(labels, dR2):
+        with stage('plot'):
+            plot_model_corr(c_dR2, f'{label}_unique', localdisk=localdisk)
+
+
+def _cross_val(localdisk, regressors, gram = False, n_jobs = 1, mmap = False, parcels = None, force = False, checkpoint = False):
+
+    # skip the regressors whose fit is up to date, so an interrupted run continues with the next regressor
+    manifest = Manifest(localdisk)
+    u_fname = 'U_atlas_wfield.npy' if os.path.isfile(pjoin(localdisk, 'U_atlas_wfield.npy')) else 'U_wfield.npy' # as in load_stack
+    inputs = ['design.npz', 'opts.json', 'SVTcorr_wfield.npy', u_fname]
+    parcels_hash = None
+    if parcels is not None:
+        parcels_hash = manifest.file_hash(os.path.abspath(parcels)) # --parcels is relative to the working directory, not to the session folder
+        if parcels_hash is None:
+            raise OSError(f'Could not find {parcels}')
+    keys = {regressor: manifest.stage_key(inputs, {'regressor': regressor, 'gram': gram, 'parcels': parcels_hash}) for regressor in regressors}
+    if force: # do not resume from the folds of an earlier run
+        for regressor in regressors:
+            shutil.rmtree(pjoin(localdisk, f'{regressor}_checkpoint'), ignore_errors=True)
+    else:
+        for regressor in regressors:
+            if manifest.is_done(f'cross_val_{regressor}', keys[regressor]):
+                print(f'{regressor} model is up to date.')
+        regressors = [regressor for regressor in regressors if not manifest.is_done(f'cross_val_{regressor}', keys[regressor])]
+    if not regressors:
+        return
+    
+    full_R, event_idx, event_labels, event_types = _load_design(localdisk)
     
     fname=pjoin(localdisk,'opts.json')                            
     if os.path.isfile(fname):                        
@@ -143,33 +409,124 @@ def _cross_val(localdisk, regressors):
     else:
         raise OSError('Could not find opts.json')
                             
-    r_stack = load_stack(localdisk) # load image stock                      
+    with stage('load'):
+        r_stack = load_stack(localdisk, 'r' if mmap else None) # load image stock                      
     
+    subsets = []
     for regressor in regressors:                        
     
         if regressor == 'full':
             labels = event_labels
         elif regressor == 'task':
-            labels = event_labels(np.bitwise_or(event_types == 1, event_types == 2))
+            labels = event_labels[np.bitwise_or(event_types == 1, event_types == 2)]
         elif regressor == 'move':
-            labels = event_labels(event_types == 3)
+            labels = event_labels[event_types == 3]
         else:
             if regressor in event_labels:
                 labels = regressor
             else:
                 raise ValueError(f'Could not find regressor {regressor}')
-                            
-        [m_stack, beta, _, idx, ridge, labels] = cross_val_model(full_R, r_stack, labels, event_idx, event_labels, opts['n_folds'])
+
+        subsets.append(regressor_subset(labels, event_idx, event_labels))
+
+    if gram: # fit all the models from one set of cross products of the full design matrix
+        m_stacks, betas, ridges = cross_val_models(full_R, r_stack, [c_idx for c_idx, _, _ in subsets], opts['n_folds'], n_jobs=n_jobs)
+
+    for i_reg, regressor in enumerate(regressors):
+
+        if gram:
+            m_stack, beta, ridge = m_stacks[i_reg], betas[i_reg], ridges[i_reg]
+            _, idx, labels = subsets[i_reg]
+        else:
+            checkpoint_dir = pjoin(localdisk, f'{regressor}_checkpoint') if checkpoint else None
+            [m_stack, beta, _, idx, ridge, labels] = cross_val_model(full_R, r_stack, subsets[i_reg][2], event_idx, event_labels, opts['n_folds'], n_jobs=n_jobs, checkpoint=checkpoint_dir, checkpoint_key=keys[regressor])
         
         # calculate correlation            
         cvR2 = model_corr(r_stack, m_stack)[0] ** 2
                             
-        np.savez(pjoin(localdisk, f'{regressor}_m'), U=m_stack.U, SVT=m_stack.SVT, beta=beta, full_R=full_R, idx=idx, ridge=ridge, labels=labels, cvR2=cvR2) # save the results
+        with stage('save'):
+            np.savez(pjoin(localdisk, f'{regressor}_m'), U=m_stack.U, SVT=m_stack.SVT, beta=beta, idx=idx, ridge=ridge, labels=labels, cvR2=cvR2, **pack_design(full_R)) # save the results
                             
         # output pdf of correlation
-        plot_model_corr(cvR2, regressor, localdisk)
+        with stage('plot'):
+            plot_model_corr(cvR2, regressor, localdisk=localdisk)
+
+        if parcels is not None: # cvR^2 of each area
+            np.savez(pjoin(localdisk, f'{regressor}_parcels'), **parcel_corr(r_stack, m_stack, np.load(parcels)))
+
+        manifest.done(f'cross_val_{regressor}', keys[regressor], [f'{regressor}_m.npz', f'{regressor}_model_corr.pdf'] + ([f'{regressor}_parcels.npz'] if parcels is not None else []))
+        if checkpoint: # the folds are no longer needed
+            shutil.rmtree(pjoin(localdisk, f'{regressor}_checkpoint'), ignore_errors=True)
                             
-def _design(localdisk, rmv = True):
+def _session_size(localdisk):
+    # bytes of imaging data of a session, to schedule the largest sessions first
+    return sum(os.path.getsize(fname) for fname in glob.glob(pjoin(localdisk, '*.npy')))
+
+
+def _process_session(localdisk, options):
+    # design matrix and cross-validation of one session, in a worker process
+
+    start = time.time()
+    prof = Profiler()
+    try:
+        with prof if options.get('profile') else contextlib.nullcontext():
+            _design(localdisk, options['rmv'], options['sparse'], options['pivot'], options['force'], options['tol'])
+            _cross_val(localdisk, options['regressors'], options['gram'], options['n_jobs'], options['mmap'], options['parcels'], options['force'], options['checkpoint'])
+        c_status = {'status': 'done', 'time': time.time() - start}
+    except Exception as err:
+        c_status = {'status': 'failed', 'time': time.time() - start, 'error': repr(err), 'traceback': traceback.format_exc()}
+    if options.get('profile'): # the profiler of the batch does not see this process, so send the profile back
+        c_status['profile'] = prof.report()
+    return c_status
+
+
+def _batch(sessions, options, processes = 1):
+
+    '''
+    Runs _process_session on every session folder on a pool of worker
+    processes, largest sessions first so that the longest runs start early.
+    A failed session is reported and does not stop the others. BLAS is
+    capped at cpu_count // processes threads in every worker. Returns the
+    status of every session.
+    '''
+
+    sessions = sorted(sessions, key=_session_size, reverse=True)
+    status = {localdisk: {'status': 'pending'} for localdisk in sessions}
+
+    # Each worker gets an equal share of the CPUs for BLAS, which its n_jobs
+    # threads split again. Spawned workers inherit the thread variables
+    # before they load BLAS; limit_cpus also caps BLAS in forked workers
+    # (with threadpoolctl), where it is already loaded.
+    n_cpus = max(1, os.cpu_count() // processes)
+
+    with blas_env(n_cpus), ProcessPoolExecutor(max_workers=processes, initializer=limit_cpus, initargs=(n_cpus,)) as pool:
+        jobs = {pool.submit(_process_session, localdisk, options): localdisk for localdisk in sessions}
+        for i_job, job in enumerate(as_completed(jobs)):
+            localdisk = jobs[job]
+            try:
+                status[localdisk] = job.result()
+            except Exception as err: # the worker process died
+                status[localdisk] = {'status': 'failed', 'error': repr(err)}
+            c_status = status[localdisk]
+            if 'profile' in c_status:
+                merge_report(c_status.pop('profile'))
+            message = f'{c_status["time"]:.1f} s' if c_status['status'] == 'done' else c_status['error']
+            print(f'[{i_job + 1}/{len(sessions)}] {localdisk}: {c_status["status"]} ({message})')
+
+    print(f'{sum(c_status["status"] == "done" for c_status in status.values())}/{len(sessions)} sessions done.')
+
+    return status
+
+
+def _pivot_info(info):
+    # result of the pivoted redundancy test, to save with the design matrix (nothing without --pivot)
+    if info is None:
+        return {}
+    return {'rank': info['rank'], 'cond_before': info['cond_before'], 'cond_after': info['cond_after'],
+            'dropped_events': np.array(list(info['dropped'].keys()), dtype=int), 'dropped_counts': np.array(list(info['dropped'].values()), dtype=int)}
+
+
+def _design(localdisk, rmv = True, sparse = False, pivot = False, force = False, tol = None):
     
     fname=pjoin(localdisk,'events.npy')
     if os.path.isfile(fname):                        
@@ -202,18 +559,28 @@ def _design(localdisk, rmv = True):
     else:
         raise OSError('Could not find opts.json')      
                             
+    # skip if the inputs and options did not change since the last build
+    manifest = Manifest(localdisk)
+    key = manifest.stage_key(['events.npy', 'trial_onsets.npy', 'opts.json'], {'frames': frames, 'rmv': rmv, 'sparse': sparse, 'pivot': pivot, 'tol': tol})
+    if not force and manifest.is_done('design', key):
+        print(f'{pjoin(localdisk, "design.npz")} is up to date.')
+        return
 
     # make design matrix
-    full_R, event_idx = make_design_matrix(event_frames, event_types, trial_onsets, opts) # make design matrix for events
+    full_R, event_idx = make_design_matrix(event_frames, event_types, trial_onsets, opts, sparse) # make design matrix for events
                             
     # calculate regressor orthogonality
-    full_QRR, full_R, event_idx = calc_regressor_orthogonality(full_R, event_idx, rmv)         
+    full_QRR, full_R, event_idx, info = calc_regressor_orthogonality(full_R, event_idx, rmv, pivot = pivot, tol = tol, return_info = True)         
                             
     # plot regressor orthogonality    
-    plot_regressor_orthogonality(full_QRR, localdisk)
+    with stage('plot'):
+        plot_regressor_orthogonality(full_QRR, localdisk)
     
     # save design matrix and event labels
-    np.savez(pjoin(localdisk, 'design'), full_R=full_R, event_idx=event_idx, event_labels=event_labels, event_types = event_types, full_QRR=full_QRR) # save design matrix and event labels
+    with stage('save'):
+        np.savez(pjoin(localdisk, 'design'), event_idx=event_idx, event_labels=event_labels, event_types = event_types, full_QRR=full_QRR, **pack_design(full_R), **_pivot_info(info)) # save design matrix and event labels
+
+    manifest.done('design', key, ['design.npz', 'regressor_orthogonality.pdf'])
                                            
              
 def main():
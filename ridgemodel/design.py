@@ -21,13 +21,54 @@
 # SOFTWARE.
 
 from .utils import *
+from scipy.sparse import csc_matrix
+import scipy.linalg as sLA
+from .profiling import profiled
 
 
-def make_design_matrix(event_frames, event_types, trial_onsets, opts):
+def kernel_index(event_type, s_frames, opts):
+
+    # lags of the design matrix for an event type
+    if event_type == 1:
+        kernel_idx = np.arange(s_frames) # index up to the shortest trial end
+    elif event_type == 2:
+        kernel_idx = np.arange(np.ceil(opts['s_post_time'] * opts['fs']).astype(int)) # index for design matrix to cover post event activity
+    elif event_type == 3:
+        kernel_idx = np.arange(-np.ceil(opts['m_pre_time']* opts['fs']).astype(int),np.ceil(opts['m_post_time']* opts['fs']).astype(int))
+    else:
+        raise ValueError('Unknown event type. Must be a value between 1 and 3.')
+
+    return kernel_idx
+
+
+def event_positions(c_events, trial_onsets):
+
+    # assign events to trials: each event goes to the first trial that ends
+    # after it, and never to a trial before that of the previous event
+    trial_cnt = np.size(trial_onsets, 0) - 1 # nr of trials
+    c_events = np.asarray(c_events).astype(np.int64).ravel()
+    c_trials = np.searchsorted(trial_onsets[1:], c_events, side='right')
+    if c_trials.size > 0:
+        c_trials = np.maximum.accumulate(c_trials)
+    c_events, c_trials = c_events[c_trials < trial_cnt], c_trials[c_trials < trial_cnt] # events after the last trial are ignored
+
+    # get the zero lag regressor of each event, relative to its trial onset
+    frames = np.diff(trial_onsets)[c_trials]
+    trace = c_events - trial_onsets[c_trials]
+    trace[trace < 0] += frames[trace < 0]
+
+    return c_trials, trace
+
+
+@profiled('make_design_matrix')
+def make_design_matrix(event_frames, event_types, trial_onsets, opts, sparse = False, dtype = np.uint8):
     ''' 
     This function generates a design matrix from a column matrix with binaryevents. 
     event_types defines the type of design matrix that is generated.
     (1 = full trial, 2 = post-event, 3 = peri-event)
+    If sparse is True, the design matrix is returned as a scipy.sparse CSC matrix.
+    The entries are stored as dtype (uint8 by default, as they are all 0 or 1);
+    functions that need floating point promote them as they go.
 
     Originally written in MATLAB by Simon Musall, 2019
     
@@ -36,74 +77,397 @@ def make_design_matrix(event_frames, event_types, trial_onsets, opts):
     '''
     random.seed(4)
     
-    full_mat = [None] * len(event_types)
     event_idx = [None] * len(event_types)
-    trial_cnt = np.size(trial_onsets, 0) - 1 # nr of trials
     s_frames = np.amin(np.diff(trial_onsets)) # number of frames in shortest trial
 
+    trial_frames = np.diff(trial_onsets) # nr of frames in each trial
+    trial_rows = trial_onsets[:-1] - trial_onsets[0] # first row of each trial in the design matrix
+
+    # Find the non-zero entries of each event type first, so that the design
+    # matrix can be allocated once, without its empty regressors.
+    rows = [None] * len(event_types)
+    cols = [None] * len(event_types)
+
     for i_reg, event_type in tqdm(enumerate(event_types), total=len(event_types),
                               desc = 'Building design matrix'):
 
-        # run over trials
-        d_mat = [None] * trial_cnt
-        
-        i_event = 0
-        total_events = len(event_frames[i_reg])
-        
-        for i_trial in range(trial_cnt):
-        
-            frames = trial_onsets[i_trial+1]-trial_onsets[i_trial]
-            
-            # determine index for current event type and trial
-            if event_type == 1:
-                kernel_idx = np.arange(s_frames) # index up to the shortest trial end
-            elif event_type == 2:
-                kernel_idx = np.arange(np.ceil(opts['s_post_time'] * opts['fs']).astype(int)) # index for design matrix to cover post event activity
-            elif event_type == 3:
-                kernel_idx = np.arange(-np.ceil(opts['m_pre_time']* opts['fs']).astype(int),np.ceil(opts['m_post_time']* opts['fs']).astype(int))
-            else:
-                print('Unknown event type. Must be a value between 1 and 3.')
-
-            # get the zero lag regressor.
-            trace = np.zeros(frames).astype(bool)
-            
-            while i_event < total_events and event_frames[i_reg][i_event] < trial_onsets[i_trial+1]:
+        kernel_idx = kernel_index(event_type, s_frames, opts) # determine index for current event type
+        c_trials, trace = event_positions(event_frames[i_reg], trial_onsets)
 
-                trace[event_frames[i_reg][i_event] - trial_onsets[i_trial]] = 1
+        frames = trial_frames[c_trials][:, np.newaxis]
+        trace = trace[:, np.newaxis]
 
-                i_event += 1
+        # lagged regressors. Lags past either end of the trial are dropped, and
+        # so is the last timepoint of each trial to avoid confusion with indexing.
+        c_idx = trace + kernel_idx
+        in_trial = (c_idx >= 0) & (c_idx <= frames - 2)
+        c_rows = (trial_rows[c_trials][:, np.newaxis] + c_idx)[in_trial]
+        c_cols = np.broadcast_to(np.arange(len(kernel_idx)), c_idx.shape)[in_trial]
 
-            # create full design matrix
-            c_idx = np.where(trace)+kernel_idx[:,np.newaxis]
-            c_idx = np.clip(c_idx,-1,frames-1)
-            c_idx = c_idx + np.arange(0,frames*len(kernel_idx),frames)[:,np.newaxis]
+        # replace the last timepoint with a shifted version of the previous timepoint
+        shifted = c_idx[:, :-1] == frames - 2
+        last_rows = np.broadcast_to(trial_rows[c_trials][:, np.newaxis] + frames - 1, shifted.shape)[shifted]
+        last_cols = np.broadcast_to(np.arange(1, len(kernel_idx)), shifted.shape)[shifted]
 
-            c_idx[c_idx < 0] = frames-1
-            c_idx[c_idx > (frames*len(kernel_idx) - 1)] = frames*len(kernel_idx) - 1
+        c_rows, c_cols = np.concatenate([c_rows, last_rows]), np.concatenate([c_cols, last_cols])
 
-            d_mat[i_trial] = np.zeros((frames,len(kernel_idx)))
+        c_idx = np.zeros(len(kernel_idx), dtype=bool) # don't use empty regressors
+        c_idx[c_cols] = True
+        rows[i_reg] = c_rows
+        cols[i_reg] = np.cumsum(c_idx)[c_cols] - 1
+        event_idx[i_reg] = np.zeros(sum(c_idx), dtype=np.ubyte)+i_reg  
 
-            d_mat[i_trial][c_idx % frames,c_idx // frames] = True
-            
-            d_mat[i_trial][-1,:] = False #  don't use last timepoint of design matrix to avoid confusion with indexing.
-            d_mat[i_trial][-1,1:] = d_mat[i_trial][-2,:-1] #  replace with shifted version of previous timepoint
+    # combine all regressors into larger matrix
+    offsets = np.cumsum([0] + [len(c_event_idx) for c_event_idx in event_idx])
+    shape = (trial_onsets[-1] - trial_onsets[0], offsets[-1])
+    if sparse:
+        rows = np.concatenate(rows)
+        cols = np.concatenate([c_cols + offset for c_cols, offset in zip(cols, offsets)])
+        full_mat = csc_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=shape)
+        full_mat.data[:] = 1 # entries that were set more than once are summed
+    else:
+        full_mat = np.zeros(shape, dtype=dtype)
+        for i_reg in range(len(event_types)):
+            full_mat[rows[i_reg], cols[i_reg] + offsets[i_reg]] = True
 
-        full_mat[i_reg] = np.vstack(d_mat) # combine all trials
-        c_idx = np.sum(full_mat[i_reg],0) > 0 # don't use empty regressors
-        full_mat[i_reg] = full_mat[i_reg][:, c_idx]
-        event_idx[i_reg] = np.zeros(sum(c_idx), dtype=np.ubyte)+i_reg  
-    
-    full_mat = np.hstack(full_mat) # combine all regressors into larger matrix
     event_idx = np.concatenate(event_idx) #  combine index so we know what is what
 
     return full_mat, event_idx
 
 
-def calc_regressor_orthogonality(R, idx, rmv = True):
-    
-    QRR = LA.qr(np.divide(R,np.sqrt(np.sum(R**2,0))),mode='r') # orthogonalize normalized design matrix
+class DesignOperator(object):
+
+    '''
+    Matrix-free version of the design matrix built by make_design_matrix
+    (same columns, in the same order, and the same event_idx). The n x p
+    matrix is never allocated: every event fills a diagonal run of
+    (frame, lag) entries, so X * B, X' * Y and X' * X are computed directly
+    from the event times, with the same trial-boundary and last-frame rules.
+
+    Usage:
+    R = DesignOperator(event_frames, event_types, trial_onsets, opts)
+    L, betas, _ = R.gram_stats(SVT.T).fit()
+    '''
+
+    def __init__(self, event_frames, event_types, trial_onsets, opts):
+
+        trial_frames = np.diff(trial_onsets) # nr of frames in each trial
+        trial_rows = trial_onsets[:-1] - trial_onsets[0] # first row of each trial in the design matrix
+        s_frames = np.amin(trial_frames) # number of frames in shortest trial
+
+        self.regs = []
+        event_idx = []
+        offset = 0
+
+        for i_reg, event_type in enumerate(event_types):
+
+            kernel_idx = kernel_index(event_type, s_frames, opts)
+            c_trials, trace = event_positions(event_frames[i_reg], trial_onsets)
+
+            # events at the same frame give the same entries
+            _, first = np.unique(trial_rows[c_trials] + trace, return_index=True)
+            c_trials, trace = c_trials[first], trace[first]
+            frames = trial_frames[c_trials]
+            n_lags = len(kernel_idx)
+
+            # lag k of an event is at row base + k, if that is inside its trial
+            # and not its last timepoint
+            base = trial_rows[c_trials] + trace + kernel_idx[0]
+            k_lo = np.clip(-trace - kernel_idx[0], 0, n_lags)
+            k_hi = np.maximum(np.clip(frames - 1 - trace - kernel_idx[0], 0, n_lags), k_lo)
+
+            # the last timepoint of a trial is a shifted version of the previous one
+            last_k = frames - 2 - trace - kernel_idx[0]
+            shifted = (last_k >= 0) & (last_k <= n_lags - 2)
+            last_rows = trial_rows[c_trials][shifted] + frames[shifted] - 1
+            last_lags = last_k[shifted] + 1
+
+            # don't use empty regressors
+            counts = np.cumsum(np.bincount(k_lo, minlength=n_lags + 1) - np.bincount(k_hi, minlength=n_lags + 1))[:-1]
+            counts += np.bincount(last_lags, minlength=n_lags)
+            c_idx = counts > 0
+            cols = np.where(c_idx, np.cumsum(c_idx) - 1 + offset, -1)
+
+            self.regs.append({'base': base, 'k_lo': k_lo, 'k_hi': k_hi, 'trials': c_trials, 'cols': cols,
+                              'counts': counts, 'last_rows': last_rows, 'last_cols': cols[last_lags]})
+            event_idx.append(np.zeros(sum(c_idx), dtype=np.ubyte)+i_reg)
+            offset += sum(c_idx)
+
+        self.event_idx = np.concatenate(event_idx)
+        self.shape = (trial_onsets[-1] - trial_onsets[0], offset)
+
+    def lags(self, reg):
+        # column and rows of every lag of an event type
+        for k in np.flatnonzero(reg['cols'] >= 0):
+            in_trial = (reg['k_lo'] <= k) & (k < reg['k_hi'])
+            yield reg['cols'][k], reg['base'][in_trial] + k
+
+    def matmat(self, B):
+        # X * B
+
+        B = np.asarray(B)
+        out = np.zeros((self.shape[0], *B.shape[1:]), dtype=np.result_type(B, np.float32))
+        for reg in self.regs:
+            for col, rows in self.lags(reg):
+                out[rows] += B[col]
+            np.add.at(out, reg['last_rows'], B[reg['last_cols']])
+
+        return out
+
+    def rmatmat(self, Y):
+        # X' * Y
+
+        out = np.zeros((self.shape[1], *Y.shape[1:]))
+        for reg in self.regs:
+            for col, rows in self.lags(reg):
+                out[col] = np.sum(Y[rows], 0, dtype=np.float64)
+            np.add.at(out, reg['last_cols'], Y[reg['last_rows']])
+
+        return out
+
+    def sum(self):
+        # column sums of X
+
+        out = np.zeros(self.shape[1])
+        for reg in self.regs:
+            out[reg['cols'][reg['cols'] >= 0]] = reg['counts'][reg['cols'] >= 0]
+
+        return out
+
+    @profiled('DesignOperator.gram')
+    def gram(self, max_entries = 10000000):
+        # X' * X, from the lagged co-occurrences of the events of each pair of event types
+
+        XTX = np.zeros((self.shape[1], self.shape[1]))
+
+        for i_reg, reg in enumerate(self.regs):
+            for c_reg in self.regs[i_reg:]:
+
+                n_lags, c_n_lags = len(reg['cols']), len(c_reg['cols'])
+                counts = np.zeros(n_lags * c_n_lags, dtype=np.int64)
+
+                # pairs of events in the same trial (rows of different trials never overlap)
+                lo = np.searchsorted(c_reg['trials'], reg['trials'], side='left')
+                hi = np.searchsorted(c_reg['trials'], reg['trials'], side='right')
+                pairs = np.repeat(np.arange(len(reg['trials'])), hi - lo)
+                c_pairs = np.arange(len(pairs)) - np.repeat(np.cumsum(hi - lo) - (hi - lo), hi - lo) + np.repeat(lo, hi - lo)
+
+                # lag k of one event and lag l = k + shift of the other are on the same row
+                shift = reg['base'][pairs] - c_reg['base'][c_pairs]
+                k_lo = np.maximum(reg['k_lo'][pairs], c_reg['k_lo'][c_pairs] - shift)
+                k_hi = np.minimum(reg['k_hi'][pairs], c_reg['k_hi'][c_pairs] - shift)
+                overlap = k_hi > k_lo
+                k_lo, k_hi, shift = k_lo[overlap], k_hi[overlap], shift[overlap]
+
+                # count the overlapping rows of every pair of lags, in bounded chunks
+                n_rows = k_hi - k_lo
+                chunk = max(1, max_entries // n_lags)
+                for start in range(0, len(n_rows), chunk):
+                    c_n_rows, c_shift = n_rows[start:start + chunk], shift[start:start + chunk]
+                    k = np.arange(np.sum(c_n_rows)) - np.repeat(np.cumsum(c_n_rows) - c_n_rows - k_lo[start:start + chunk], c_n_rows)
+                    counts += np.bincount(k * c_n_lags + k + np.repeat(c_shift, c_n_rows), minlength=n_lags * c_n_lags)
+
+                counts = counts.reshape(n_lags, c_n_lags)[reg['cols'] >= 0][:, c_reg['cols'] >= 0]
+                cols, c_cols = reg['cols'][reg['cols'] >= 0], c_reg['cols'][c_reg['cols'] >= 0]
+                XTX[np.ix_(cols, c_cols)] = counts
+                XTX[np.ix_(c_cols, cols)] = counts.T
+
+        # the last timepoints of each trial, which only overlap with each other
+        last_rows = np.concatenate([reg['last_rows'] for reg in self.regs])
+        last_cols = np.concatenate([reg['last_cols'] for reg in self.regs])
+        _, last_rows = np.unique(last_rows, return_inverse=True)
+        last_R = csc_matrix((np.ones(len(last_rows)), (last_rows, last_cols)), shape=(np.max(last_rows, initial=-1) + 1, self.shape[1]))
+        XTX += (last_R.T @ last_R).toarray()
+
+        return XTX
+
+    def gram_stats(self, Y):
+        # centered cross products of X and Y (frames x components), for GramStats.fit
+
+        Y = np.asarray(Y, dtype=np.float64)
+        stats = GramStats(self.shape[1], np.size(Y, 1))
+        stats.n = self.shape[0]
+        stats.X_mean = self.sum() / stats.n
+        stats.Y_mean = np.mean(Y, 0)
+        Y = Y - stats.Y_mean
+        stats.XTX = self.gram() - stats.n * np.outer(stats.X_mean, stats.X_mean)
+        stats.XTY = self.rmatmat(Y) # Y is centered, so X' * Y needs no correction
+        stats.Y_var = np.sum(Y ** 2, 0)
+
+        return stats
+
+    def toarray(self, dtype = np.uint8):
+
+        out = np.zeros(self.shape, dtype=dtype)
+        for reg in self.regs:
+            for col, rows in self.lags(reg):
+                out[rows, col] = 1
+            out[reg['last_rows'], reg['last_cols']] = 1
+
+        return out
+
+
+def column_norms(R, chunk_size = 10000):
+    # euclidean norm of every column, accumulated over row chunks for dense or memory-mapped matrices
+
+    if issparse(R):
+        f_R = R.astype(np.float64)
+        return np.sqrt(np.asarray(f_R.multiply(f_R).sum(0)).ravel())
+
+    sq_sum = np.zeros(np.size(R,1))
+    for start in range(0, np.size(R,0), chunk_size):
+        c_R = np.asarray(R[start:start + chunk_size])
+        sq_sum += np.einsum('ij,ij->j', c_R, c_R, dtype=np.float64)
+
+    return np.sqrt(sq_sum)
+
+
+def tsqr(R, norms, chunk_size = 10000):
+    '''
+    R factor of the QR decomposition of the column-normalized design matrix,
+    computed as a tall-skinny QR over row chunks: each chunk is stacked under
+    the R of all previous rows and re-factorized. Only one chunk is dense at a
+    time, so this works for sparse and memory-mapped matrices. The result
+    equals LA.qr(R / norms, mode='r') up to the sign of each row.
+    '''
+
+    chunk_size = max(chunk_size, 2 * np.size(R,1)) # keep the stacked R a small part of each factorization
+    if issparse(R):
+        R = R.tocsr() # fast row slicing
+
+    QRR = np.zeros((0, np.size(R,1)))
+    for start in range(0, np.size(R,0), chunk_size):
+        c_R = R[start:start + chunk_size]
+        c_R = c_R.toarray() if issparse(c_R) else np.asarray(c_R)
+        QRR = LA.qr(np.vstack([QRR, c_R / norms]), mode='r')
+
+    return QRR
+
+
+def gram_cholesky(XTX, tol = None):
+    '''
+    Upper triangular R with R' * R = XTX for a positive semi-definite XTX.
+    Columns that are (numerically) in the span of the previous ones get a zero
+    row, as a rank-deficient QR would give. Because the Gram matrix squares
+    the condition number, the tolerance is on the squared diagonal and
+    defaults to p * eps times its largest entry.
+    '''
+
+    p = np.size(XTX,0)
+    if tol is None:
+        tol = p * np.finfo(np.float64).eps * np.max(np.diagonal(XTX))
+
+    QRR = np.zeros((p, p))
+    for j in range(p):
+        d = XTX[j,j] - QRR[:j,j] @ QRR[:j,j] # squared distance of column j from the span of the previous columns
+        if d > tol:
+            QRR[j,j] = np.sqrt(d)
+            QRR[j,j+1:] = (XTX[j,j+1:] - QRR[:j,j] @ QRR[:j,j+1:]) / QRR[j,j]
+
+    return QRR
+
+
+def find_redundant_regressors(QRR, idx, n_rows, tol = None):
+    '''
+    Rank-revealing redundancy test: a column-pivoted QR of the R factor of the
+    normalized design matrix (R' * R is its Gram matrix, so this is one small
+    p x p factorization) picks the most independent regressors first, and the
+    ones left after the numerical rank are redundant. Unlike the unpivoted
+    diagonal this does not depend on the column order and never keeps a near
+    duplicate that leaves X' * X ill-conditioned.
+
+    tol is the smallest |R_ii| / |R_00| of a kept regressor, 1e-6 by
+    default, so that near duplicates are dropped as well and the condition
+    number of the kept columns stays in the order of 1 / tol. Use
+    max(n, p) * eps to only drop exactly redundant regressors, as the
+    unpivoted check does.
+
+    Returns a boolean index of the regressors to keep and a dict with the
+    condition numbers before and after pruning and the number of dropped
+    columns for each event_idx group.
+    '''
+
+    PQRR, piv = sLA.qr(QRR, mode='r', pivoting=True)
+    diag_R = abs(np.diagonal(PQRR))
+    if tol is None:
+        tol = 1e-6
+    rank = np.sum(diag_R > tol * diag_R[0])
+
+    keep_idx = np.zeros(np.size(QRR,1), dtype=bool)
+    keep_idx[piv[:rank]] = True
+
+    groups, counts = np.unique(idx[~keep_idx], return_counts=True)
+    info = {'rank': int(rank),
+            'cond_before': condition_number(QRR),
+            'cond_after': condition_number(QRR[:,keep_idx]),
+            'dropped': dict(zip(groups.tolist(), counts.tolist()))}
+
+    return keep_idx, info
+
+
+def condition_number(QRR):
+    # condition number of the normalized design matrix from its R factor (inf if rank deficient)
+    s = sLA.svdvals(QRR)
+    return float(s[0] / s[-1]) if s[-1] > 0 else np.inf
+
+
+@profiled('calc_regressor_orthogonality')
+def calc_regressor_orthogonality(R, idx, rmv = True, method = 'tsqr', chunk_size = 10000, pivot = False, tol = None, return_info = False):
+    '''
+    Orthogonalizes the normalized design matrix and checks for redundant
+    regressors, using the diagonal of its R factor.
+
+    method : 'tsqr' streams row chunks through a tall-skinny QR (same diagonal
+             as the full QR, one dense chunk in memory at a time), 'gram' uses
+             a Cholesky factorization of the normalized X' * X (fastest, in
+             particular for sparse matrices, but only resolves redundancy down
+             to sqrt(eps)), 'qr' factorizes the full dense matrix at once.
+    pivot  : select the redundant regressors with a column-pivoted
+             (rank-revealing) factorization instead of the unpivoted diagonal,
+             and print the condition numbers and dropped columns per group.
+             The returned QRR stays unpivoted, in the order of the regressors.
+    tol    : relative rank tolerance of the pivoted test (see
+             find_redundant_regressors).
+    return_info : also return the rank, condition numbers and dropped columns
+             per group of the pivoted test (None without pivot).
+    '''
+
+    norms = column_norms(R, chunk_size)
+
+    if method == 'tsqr':
+        QRR = tsqr(R, norms, chunk_size)
+    elif method == 'gram':
+        if issparse(R):
+            XTX = (R.T @ R.astype(np.float64)).toarray()
+        else:
+            XTX = np.zeros((np.size(R,1), np.size(R,1)))
+            for start in range(0, np.size(R,0), chunk_size):
+                c_R = np.asarray(R[start:start + chunk_size], dtype=np.float64)
+                XTX += c_R.T @ c_R
+        QRR = gram_cholesky(XTX / np.outer(norms, norms))
+    elif method == 'qr':
+        if issparse(R):
+            norm_R = R.astype(np.float64).multiply(1 / norms).toarray() # the QR needs the dense normalized design matrix
+        else:
+            norm_R = np.divide(R, norms)
+        QRR = LA.qr(norm_R,mode='r') # orthogonalize normalized design matrix
+    else:
+        raise ValueError("Unknown method. Must be 'tsqr', 'gram' or 'qr'.")
     
-    if np.sum(abs(np.diagonal(QRR)) > np.max(np.shape(R)) * abs(np.spacing(QRR[0,0]))) < np.size(R,1): # check if design matrix is full rank
+    info = None
+    if pivot:
+        keep_idx, info = find_redundant_regressors(QRR, idx, np.size(R,0), tol)
+        print(f'Design matrix has rank {info["rank"]}/{np.size(R,1)} (condition number {info["cond_before"]:.3g}, {info["cond_after"]:.3g} after pruning).')
+        if not np.all(keep_idx):
+            print('Redundant regressors per event: ' + ', '.join(f'{group}: {count}' for group, count in info['dropped'].items()))
+            if rmv:
+                warnings.warn(f'Warning: design matrix contains redundant regressors! Removing {np.sum(~keep_idx)}/{np.size(R,1)} regressors.')
+                R = R[:,keep_idx]
+                idx = idx[keep_idx]
+            else:
+                warnings.warn('Warning: design matrix contains redundant regressors! This will break the model.')
+
+    elif np.sum(abs(np.diagonal(QRR)) > np.max(np.shape(R)) * abs(np.spacing(QRR[0,0]))) < np.size(R,1): # check if design matrix is full rank
         if rmv:
             keep_idx = abs(np.diagonal(QRR)) > max(np.shape(R)) * abs(np.spacing(QRR[0,0])) # reject regressors that cause rank-defficint matrix
             warnings.warn(f'Warning: design matrix contains redundant regressors! Removing {np.sum(~keep_idx)}/{np.size(R,1)} regressors.')
@@ -112,4 +476,6 @@ def calc_regressor_orthogonality(R, idx, rmv = True):
         else:
             warnings.warn('Warning: design matrix contains redundant regressors! This will break the model.')           
                       
+    if return_info:
+        return QRR, R, idx, info
     return QRR, R, idx
\ No newline at end of file
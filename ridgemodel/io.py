@@ -21,24 +21,30 @@
 # SOFTWARE.
 
 import h5py
+import hashlib
+import time
 
 from .utils import *
+from scipy.sparse import csc_matrix
+from .profiling import profiled
 
-def load_stack(localdisk):
+def load_stack(localdisk, mmap_mode = None):
+
+    # mmap_mode is passed to np.load, e.g. 'r' to map the components instead of reading them into memory
 
     fname = pjoin(localdisk,'SVTcorr_wfield.npy')
     if os.path.isfile(fname):
-        SVT = np.load(fname) # load adjusted temporal components
+        SVT = np.load(fname, mmap_mode=mmap_mode) # load adjusted temporal components
     else:
         raise OSError(f'Could not find: {fname}')
 
     fname = pjoin(localdisk,'U_atlas_wfield.npy')
     if os.path.isfile(fname):
-        U = np.load(fname) # load aligned spatial components
+        U = np.load(fname, mmap_mode=mmap_mode) # load aligned spatial components
     else:
         fname = pjoin(localdisk,'U_wfield.npy')
         if os.path.isfile(fname):
-            U = np.load(fname) # If no aligned spatial components, load regular spatial components
+            U = np.load(fname, mmap_mode=mmap_mode) # If no aligned spatial components, load regular spatial components
         else:
             raise OSError(f'Could not find: {fname}')
 
@@ -70,3 +76,96 @@ def load_events(localdisk):
 
     return events
 
+
+def pack_design(full_R):
+
+    # arrays to store a (possibly sparse) design matrix in an npz file
+    if issparse(full_R):
+        full_R = full_R.tocsc()
+        return {'full_R_data': full_R.data, 'full_R_indices': full_R.indices,
+                'full_R_indptr': full_R.indptr, 'full_R_shape': np.array(full_R.shape)}
+
+    if full_R.dtype in [np.bool_, np.uint8] and np.all(full_R <= 1): # binary matrices are stored as one bit per entry
+        return {'full_R_bits': np.packbits(full_R, axis=0), 'full_R_shape': np.array(full_R.shape),
+                'full_R_dtype': str(full_R.dtype)}
+
+    return {'full_R': full_R}
+
+
+def unpack_design(design_f):
+
+    # design matrix from the arrays written by pack_design
+    if 'full_R' in design_f:
+        return design_f['full_R']
+
+    if 'full_R_bits' in design_f:
+        full_R = np.unpackbits(design_f['full_R_bits'], axis=0, count=int(design_f['full_R_shape'][0]))
+        return full_R.astype(str(design_f['full_R_dtype']), copy=False)
+
+    return csc_matrix((design_f['full_R_data'], design_f['full_R_indices'], design_f['full_R_indptr']),
+                      shape=tuple(design_f['full_R_shape']))
+
+
+class Manifest(object):
+
+    '''
+    Record of the pipeline stages that were completed in a session folder
+    (manifest.json). Each stage is stored with a key, the hash of the
+    contents of its input files and of its options, and its output files.
+    A stage whose key is unchanged and whose outputs exist can be skipped.
+
+    File hashes are kept in the manifest with the size and modification
+    time of the file, so a file is only hashed again after it changed.
+    '''
+
+    def __init__(self, localdisk, fname = 'manifest.json'):
+        self.localdisk = localdisk
+        self.fname = pjoin(localdisk, fname)
+        if os.path.isfile(self.fname):
+            with open(self.fname, 'r') as manifest_f:
+                self.data = json.load(manifest_f)
+        else:
+            self.data = {'files': {}, 'stages': {}}
+
+    @profiled('hash')
+    def file_hash(self, fname, chunk_size = 2**24):
+        path = os.path.abspath(pjoin(self.localdisk, fname))
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        c_stat = [stat.st_size, stat.st_mtime_ns]
+        cached = self.data['files'].get(path)
+        if cached is not None and cached['stat'] == c_stat:
+            return cached['sha256']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as c_file:
+            for chunk in iter(lambda: c_file.read(chunk_size), b''):
+                sha.update(chunk)
+        self.data['files'][path] = {'stat': c_stat, 'sha256': sha.hexdigest()}
+        return sha.hexdigest()
+
+    def stage_key(self, files, options = None):
+        # hash of the contents of the input files (names relative to the session folder) and the options
+        sha = hashlib.sha256()
+        for fname in files:
+            c_hash = self.file_hash(fname)
+            if c_hash is None: # a missing input must not make a valid key
+                raise OSError(f'Could not find {pjoin(self.localdisk, fname)}')
+            sha.update(f'{fname}:{c_hash};'.encode())
+        sha.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def is_done(self, stage, key):
+        entry = self.data['stages'].get(stage)
+        return entry is not None and entry['key'] == key and all(os.path.isfile(pjoin(self.localdisk, fname)) for fname in entry['outputs'])
+
+    def done(self, stage, key, outputs):
+        self.data['stages'][stage] = {'key': key, 'outputs': outputs, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save()
+
+    def save(self):
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as manifest_f:
+            json.dump(self.data, manifest_f, indent=2)
+        os.replace(tmp_fname, self.fname) # never leave a partly written manifest
@@ -0,0 +1,204 @@
+# MIT License
+
+# Copyright (c) 2019 Churchland laboratory
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+
+
+def current_rss():
+    # resident memory of this process in bytes (peak so far where /proc is not available)
+    try:
+        with open('/proc/self/statm') as statm_f:
+            return int(statm_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class PeakMemory(object):
+
+    '''
+    Samples the resident memory of the process in a background thread while
+    a with block runs. peak is the largest value seen (bytes), baseline the
+    value at the start.
+    '''
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+_profilers = [] # active profilers, innermost last
+
+
+class Profiler(object):
+
+    '''
+    Records the wall time, CPU time (of the whole process, so including BLAS
+    and worker threads), peak resident memory and number of calls of every
+    named stage that runs inside a with block, and the counters incremented
+    with count (e.g. NLL evaluations of the lambda search).
+
+    Without an active Profiler, stage and count do nothing.
+
+    Usage:
+    with Profiler() as prof:
+        ridge_MML(Y, X)
+    prof.save('profile.json')
+    '''
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.stages = {}
+        self.counters = {}
+        self._open = {} # open stage records (by id), whose peak memory is being tracked
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start, self.start_cpu = time.perf_counter(), time.process_time()
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        _profilers.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _profilers.remove(self)
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        self.wall, self.cpu = time.perf_counter() - self.start, time.process_time() - self.start_cpu
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            self.peak = max(self.peak, rss)
+            with self._lock:
+                for record in self._open.values():
+                    record['peak'] = max(record['peak'], rss)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {'peak': current_rss()}
+        with self._lock:
+            self._open[id(record)] = record
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            with self._lock:
+                del self._open[id(record)]
+                c_stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+                c_stage['calls'] += 1
+                c_stage['wall'] += wall
+                c_stage['cpu'] += cpu
+                c_stage['peak_rss_mb'] = max(c_stage['peak_rss_mb'], max(record['peak'], current_rss()) / 2**20)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge(self, report):
+        # add the stages and counters of a report of another profiler, e.g. of a
+        # worker process. Times and calls are added up; the peak memory of a
+        # stage stays the largest of any one process.
+        with self._lock:
+            for name, other in report['stages'].items():
+                c_stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+                c_stage['calls'] += other['calls']
+                c_stage['wall'] += other['wall']
+                c_stage['cpu'] += other['cpu']
+                c_stage['peak_rss_mb'] = max(c_stage['peak_rss_mb'], other['peak_rss_mb'])
+            for name, n in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        # stages, counters and the counts per column of the lambda search
+        counters = self.counters
+        per_column = {}
+        if counters.get('lambda_columns'):
+            per_column['nll_evaluations'] = counters.get('nll_evaluations', 0) / counters['lambda_columns']
+            per_column['convergence_failures'] = counters.get('convergence_failures', 0) / counters['lambda_columns']
+        if counters.get('fminbound_columns'):
+            per_column['fminbound_iterations'] = counters.get('fminbound_iterations', 0) / counters['fminbound_columns']
+
+        return {'total': {'wall': getattr(self, 'wall', None), 'cpu': getattr(self, 'cpu', None), 'peak_rss_mb': self.peak / 2**20},
+                'stages': dict(sorted(self.stages.items(), key=lambda item: -item[1]['wall'])),
+                'counters': dict(counters), 'per_column': per_column}
+
+    def save(self, fname):
+        with open(fname, 'w') as profile_f:
+            json.dump(self.report(), profile_f, indent=2)
+
+
+def stage(name):
+    # time a block as stage name in the active profiler (if any)
+    if not _profilers:
+        return contextlib.nullcontext()
+    return _profilers[-1].stage(name)
+
+
+def count(name, n = 1):
+    # add n to the counter name of the active profiler (if any)
+    if _profilers:
+        _profilers[-1].count(name, n)
+
+
+def merge_report(report):
+    # add a report of another profiler (e.g. of a worker process) to the active profiler (if any)
+    if _profilers:
+        _profilers[-1].merge(report)
+
+
+def profiled(name):
+    # decorator that times every call of a function as stage name
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _profilers:
+                return func(*args, **kwargs)
+            with _profilers[-1].stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
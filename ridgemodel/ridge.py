@@ -21,8 +21,11 @@
 # SOFTWARE.
 
 from .utils import *
+from scipy.sparse import issparse
+from .profiling import stage, count, profiled
 
-def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures = True):
+@profiled('ridge_MML')
+def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures = True, conservative = False):
     """
     This is an implementation of Ridge regression with the Ridge parameter
     lambda determined using the fast algorithm of Karabatsos 2017 (see
@@ -55,6 +58,15 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
     If lambdas is supplied, the optimization step is skipped and the betas
     are computed immediately. This obviously speeds things up a lot.
 
+    X may be a scipy.sparse matrix, in which case (with recenter = True) the
+    fit is done from X'X and X'Y, as in ridge_MML_gram.
+
+    If recenter is True, the betas for all columns of Y are computed at once
+    from the SVD of X (the same SVD used to find the lambdas). Set
+    conservative to True to instead solve (X'X + lambda*I) * beta = X'Y
+    separately for each column of Y, which is slower but numerically more
+    conservative.
+
 
     TECHNICAL DETAILS:
 
@@ -98,6 +110,16 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
     if np.size(Y, 0) != np.size(X, 0):
           error('Size mismatch')
 
+    ## Sparse design matrices
+    # These are fit from their cross products, so that centering X never
+    # densifies it
+
+    if issparse(X):
+        if recenter:
+            return GramStats.from_data(X, Y).fit(L = L, regress = regress, display_failures = display_failures,
+                                                 conservative = conservative)
+        X = X.toarray()
+
     ## Ensure Y is zero-mean
     # This is needed to estimate lambdas, but if recenter = 0, the mean will be
     # restored later for the beta estimation
@@ -124,7 +146,8 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
 
         ## SVD the predictors
 
-        U, d, VH = np.linalg.svd(X,full_matrices=False)
+        with stage('ridge_MML.svd'):
+            U, d, VH = np.linalg.svd(X,full_matrices=False)
         S = np.diag(d)
         V = VH.T.conj()
 
@@ -151,16 +174,11 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
         Y_var = np.sum(Y ** 2, 0)
 
         ## Compute the lambdas
+        # All columns of Y share d2, q and n, so the search is run for every
+        # column at once (see ridge_MML_all_Y)
 
-        L = np.full(pY,np.nan)
+        L, convergence_failures = ridge_MML_all_Y(q, d2, n, Y_var, alpha2)
 
-        convergence_failures = np.empty(pY, dtype=int)
-        
-        for i in range(pY):
-            
-            L[i], flag = ridge_MML_one_Y(q, d2, n, Y_var[i], alpha2[:, i])
-            convergence_failures[i] = flag
-        
     else:
         p = np.size(X, 1)
 
@@ -196,7 +214,7 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
             # Note that the rescaling doesn't alter the intercept.
             renorm = np.insert(X_std, 0, 1)
 
-        else:
+        elif conservative:
             betas = np.full((p, pY), np.nan)
 
             # You would think you could compute X'X more efficiently as VSSV', but
@@ -211,13 +229,31 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
             # For renorming the betas
             renorm = X_std.T
 
+        if recenter and not conservative:
 
-        # Compute X' * Y all at once, again for speed
-        XTY = X.T @ Y
+            # Compute betas for renormed X from the SVD, for all columns at once:
+            # (X'X + L*I)^-1 * X'Y = V * diag(d / (d^2 + L)) * U' * Y
+            if not compute_L:
+                with stage('ridge_MML.svd'):
+                    U, d, VH = np.linalg.svd(X,full_matrices=False)
 
-        # Compute betas for renormed X
-        for i in range(0,pY):
-            betas[:, i] = np.linalg.solve(XTX + L[i] * ep, XTY[:, i])
+            with stage('ridge_MML.solve'):
+                shrink = d[:, np.newaxis] / (d[:, np.newaxis] ** 2 + np.reshape(L, (1, -1)))
+                betas = VH.T @ (shrink * (U.T @ Y))
+            betas[X_std == 0] = 0 # constant regressors were zeroed above and get no weight
+
+            # For renorming the betas
+            renorm = X_std.T
+
+        else:
+
+            # Compute X' * Y all at once, again for speed
+            XTY = X.T @ Y
+
+            # Compute betas for renormed X
+            with stage('ridge_MML.solve'):
+                for i in range(0,pY):
+                    betas[:, i] = np.linalg.solve(XTX + L[i] * ep, XTY[:, i])
 
         # Adjust betas to account for renorming.
         betas = np.divide(betas.T, renorm).T
@@ -236,138 +272,590 @@ def ridge_MML(Y, X, recenter = True, L = None, regress = True, display_failures
         return betas
     
 
-def ridge_MML_one_Y(q, d2, n, Y_var, alpha2):
-    
-    # Compute the lambda for one column of Y
+def ridge_MML_gram(XTX, XTY, X_sum, Y_sum, YTY, n, L = None, regress = True, display_failures = True, conservative = False):
+    """
+    Ridge regression with marginal maximum likelihood lambdas (as in
+    ridge_MML, with recenter = True) computed from sufficient statistics
+    instead of the data itself, so that the cost does not depend on the
+    number of observations.
+
+    Inputs are X'X (p x p), X'Y (p x pY), the column sums of X and Y, Y'Y
+    (pY x pY, or only its diagonal) and n, the number of observations they
+    were computed from. Outputs are the same as ridge_MML.
+
+    The SVD of X is replaced by an eigendecomposition of the standardized
+    X'X, which gives d^2 and the rotated alpha directly.
+    """
+
+    X_mean = np.divide(X_sum, n)
+    Y_mean = np.divide(Y_sum, n)
+
+    if np.ndim(YTY) == 2:
+        YTY = np.diagonal(YTY)
+
+    # Center the cross products
+    XTX = XTX - n * np.outer(X_mean, X_mean)
+    XTY = XTY - n * np.outer(X_mean, Y_mean)
+    Y_var = YTY - n * Y_mean ** 2
+
+    return ridge_MML_centered(XTX, XTY, Y_var, n, L = L, regress = regress,
+                              display_failures = display_failures, conservative = conservative)
+
+
+@profiled('ridge_MML_centered')
+def ridge_MML_centered(XTX, XTY, Y_var, n, L = None, regress = True, display_failures = True, conservative = False):
+    """
+    Same as ridge_MML_gram, but from the centered cross products of X and Y,
+    i.e. X'X and X'Y after subtracting the column means, and the sum of
+    squares of each (centered) column of Y.
+    """
+
+    ## Optional arguments
+
+    if L is None:
+          compute_L = True
+    else:
+          compute_L = False
+
+    pY = np.size(XTY, 1)
+    p = np.size(XTX, 0)
+
+    ## Renorm (Z-score)
+
+    XTX, XTY, X_std = zscore_cross_products(XTX, XTY, n)
+
+    ## Eigendecompose the standardized X'X (= V * diag(d2) * V')
+
+    if compute_L or not conservative:
+        d2, V = eigh_descending(XTX)
+
+        # alph = V' * X' * Y
+        alph = V.T @ XTY
+
+    ## Optimize lambda
+
+    if compute_L:
+
+        # Find the number of good eigenvalues. Ensure numerical stability.
+        q = np.sum(d2 > p * abs(np.spacing(d2[0])))
+
+        alpha2 = alph ** 2
+
+        ## Compute the lambdas
+
+        L, convergence_failures = ridge_MML_all_Y(q, d2, n, Y_var, alpha2)
+
+    # If requested, perform the actual regression
+
+    if regress:
+
+        if conservative:
+            betas = np.full((p, pY), np.nan)
+            ep = np.identity(p)
+
+            # Compute betas for renormed X
+            with stage('ridge_MML.solve'):
+                for i in range(0,pY):
+                    betas[:, i] = np.linalg.solve(XTX + L[i] * ep, XTY[:, i])
+
+        else:
+            # (X'X + L*I)^-1 * X'Y = V * diag(1 / (d^2 + L)) * V' * X'Y
+            with stage('ridge_MML.solve'):
+                betas = V @ (alph / (d2[:, np.newaxis] + np.reshape(L, (1, -1))))
+            betas[X_std == 0] = 0 # constant regressors get no weight
+
+        # Adjust betas to account for renorming.
+        betas = np.divide(betas.T, X_std).T
+        betas[np.isnan(betas)] = 0
+
+    ## Display fminbnd failures
+
+    if compute_L and display_failures and sum(convergence_failures) > 0:
+        print(f'fminbnd failed to converge {sum(convergence_failures)}/{pY} times')
+
+    if not regress:
+        betas = None
+
+    if compute_L:
+        return L, betas, convergence_failures
+    else:
+        return betas
+
+
+def zscore_cross_products(XTX, XTY, n):
+    # Rescale centered cross products as if the columns of X had been
+    # z-scored. Columns without variance are zeroed, as in ridge_MML.
+
+    X_std = np.sqrt(np.diagonal(XTX) / (n - 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        XTX = XTX / np.outer(X_std, X_std)
+        XTY = XTY / X_std[:, np.newaxis]
+    XTX[~np.isfinite(XTX)] = 0
+    XTY[~np.isfinite(XTY)] = 0
+
+    return XTX, XTY, X_std
+
+
+@profiled('ridge_MML.eigh')
+def eigh_descending(XTX):
+    # Eigendecomposition of X'X, largest eigenvalue first (as the singular values of X)
+
+    d2, V = np.linalg.eigh(XTX)
+
+    return np.clip(d2[::-1], 0, None), V[:, ::-1]
+
+
+def ridge_drop_groups(XTX, XTY, n, L, groups):
+    """
+    Betas of the reduced models that leave out one group of regressors at a
+    time, computed from the centered cross products of the full model.
+
+    groups is a list of column masks. Each reduced model keeps the lambdas
+    of the full model, so it can be derived from the full model's
+    eigendecomposition X'X = V * diag(d2) * V' instead of being refit: with
+    A = X'X + L*I and g the columns that are left out, the block inverse of A
+    gives
+
+        beta_reduced = beta - A^-1[:, g] * (A^-1[g, g])^-1 * beta[g]
+
+    which only needs a k x k solve per column of Y, where k is the size of
+    the group. Returns the betas of the full model and a list with the betas
+    of each reduced model, with zeros in the rows that were left out.
+    """
+
+    XTX, XTY, X_std = zscore_cross_products(XTX, XTY, n)
+    d2, V = eigh_descending(XTX)
+
+    A_inv_d = 1 / (d2[:, np.newaxis] + np.reshape(L, (1, -1))) # p x pY, A^-1 = V * diag(A_inv_d[:, i]) * V'
+    beta = V @ (A_inv_d * (V.T @ XTY))
+
+    reduced = []
+    for g in groups:
+        W = V[g, :] # k x p
+        A_inv_gg = np.matmul(W[np.newaxis] * A_inv_d.T[:, np.newaxis, :], W.T[np.newaxis]) # pY x k x k, as one batched matmul
+        t = np.linalg.solve(A_inv_gg, beta[g].T[:, :, np.newaxis])[:, :, 0] # pY x k
+        c_beta = beta - V @ (A_inv_d * (W.T @ t.T))
+        c_beta[g] = 0
+        reduced.append(c_beta)
+
+    # Adjust betas to account for renorming.
+    betas = []
+    for c_beta in [beta] + reduced:
+        c_beta[X_std == 0] = 0 # constant regressors get no weight
+        c_beta = np.divide(c_beta.T, X_std).T
+        c_beta[np.isnan(c_beta)] = 0
+        betas.append(c_beta)
+
+    return betas[0], betas[1:]
+
+
+class GramStats(object):
+    '''
+    Centered sufficient statistics of a design matrix X and data Y: the
+    number of observations, the column means, the centered cross products
+    X'X and X'Y and the centered sum of squares of each column of Y.
+
+    Statistics are accumulated one block of rows at a time and blocks are
+    combined with the pairwise update of Chan et al. (1979), so no raw,
+    uncentered sums are ever formed. Blocks can also be removed again, which
+    gives the statistics of the remaining rows.
+    '''
+
+    def __init__(self, p, pY):
+        self.n = 0
+        self.X_mean = np.zeros(p)
+        self.Y_mean = np.zeros(pY)
+        self.XTX = np.zeros((p, p))
+        self.XTY = np.zeros((p, pY))
+        self.Y_var = np.zeros(pY)
+
+    @classmethod
+    def from_data(cls, X, Y):
+
+        Y = np.asarray(Y, dtype=np.float64)
+
+        stats = cls(np.shape(X)[1], np.size(Y, 1))
+        stats.n = np.shape(X)[0]
+        if stats.n == 0:
+            return stats
+
+        stats.Y_mean = np.mean(Y, 0)
+        Y = Y - stats.Y_mean
+        stats.Y_var = np.sum(Y ** 2, 0)
+
+        if issparse(X):
+            # center the cross products rather than X, which would make it dense.
+            # X' * Y needs no correction because Y is already centered.
+            X = X.astype(np.float64)
+            stats.X_mean = np.asarray(X.mean(0)).ravel()
+            stats.XTX = (X.T @ X).toarray() - stats.n * np.outer(stats.X_mean, stats.X_mean)
+            stats.XTY = np.asarray(X.T @ Y)
+        else:
+            X = np.asarray(X, dtype=np.float64)
+            stats.X_mean = np.mean(X, 0)
+            X = X - stats.X_mean
+            stats.XTX = X.T @ X
+            stats.XTY = X.T @ Y
+
+        return stats
+
+    def update(self, X, Y):
+        # add a block of rows
+        return self.merge(GramStats.from_data(X, Y))
+
+    def merge(self, other):
+
+        n = self.n + other.n
+        if other.n == 0:
+            return self
+        dX = other.X_mean - self.X_mean
+        dY = other.Y_mean - self.Y_mean
+        w = self.n * other.n / n
+
+        self.XTX += other.XTX + w * np.outer(dX, dX)
+        self.XTY += other.XTY + w * np.outer(dX, dY)
+        self.Y_var += other.Y_var + w * dY ** 2
+        self.X_mean += dX * other.n / n
+        self.Y_mean += dY * other.n / n
+        self.n = n
+
+        return self
+
+    def subtract(self, other):
+        # statistics of the rows that are not in other (which must be a subset of these rows)
+
+        stats = copy.deepcopy(self)
+        n = self.n - other.n
+        if other.n == 0:
+            return stats
+        X_mean = (self.n * self.X_mean - other.n * other.X_mean) / n
+        Y_mean = (self.n * self.Y_mean - other.n * other.Y_mean) / n
+        dX = other.X_mean - X_mean
+        dY = other.Y_mean - Y_mean
+        w = n * other.n / self.n
+
+        stats.XTX = self.XTX - other.XTX - w * np.outer(dX, dX)
+        stats.XTY = self.XTY - other.XTY - w * np.outer(dX, dY)
+        stats.Y_var = self.Y_var - other.Y_var - w * dY ** 2
+        stats.X_mean, stats.Y_mean, stats.n = X_mean, Y_mean, n
+
+        # Columns of X that are all zero in the remaining rows (e.g. an event
+        # that only occurs in the removed rows) must come out exactly zero and
+        # not as rounding errors, which would be blown up by the z-scoring
+        X_ss = np.diagonal(self.XTX) + self.n * self.X_mean ** 2
+        X_ss_other = np.diagonal(other.XTX) + other.n * other.X_mean ** 2
+        empty = X_ss - X_ss_other <= 100 * np.finfo(float).eps * X_ss
+        stats.XTX[empty, :] = 0
+        stats.XTX[:, empty] = 0
+        stats.XTY[empty] = 0
+        stats.X_mean[empty] = 0
+
+        return stats
+
+    def subset(self, c_idx):
+        # statistics of the model that only uses the columns of X in c_idx
+
+        stats = GramStats(0, 0)
+        stats.n = self.n
+        stats.X_mean = self.X_mean[c_idx]
+        stats.Y_mean = self.Y_mean.copy()
+        stats.XTX = self.XTX[np.ix_(c_idx, c_idx)]
+        stats.XTY = self.XTY[c_idx]
+        stats.Y_var = self.Y_var.copy()
+
+        return stats
+
+    def fit(self, L = None, regress = True, display_failures = True, conservative = False):
+
+        return ridge_MML_centered(self.XTX, self.XTY, self.Y_var, self.n, L = L, regress = regress,
+                                  display_failures = display_failures, conservative = conservative)
+
+    def fit_drop_groups(self, L, groups):
+
+        return ridge_drop_groups(self.XTX, self.XTY, self.n, L, groups)
+
+
+def ridge_MML_stream(chunks, L = None, regress = True, display_failures = True, conservative = False):
+    """
+    Out-of-core version of ridge_MML (with recenter = True). chunks is an
+    iterable of (X_chunk, Y_chunk) row blocks, for example from iter_chunks.
+    Only one chunk is held in memory at a time, together with the p x p and
+    p x pY cross products. Outputs are the same as ridge_MML.
+    """
+
+    stats = None
+    for X_chunk, Y_chunk in chunks:
+        if stats is None:
+            stats = GramStats(np.size(X_chunk, 1), np.size(Y_chunk, 1))
+        stats.update(X_chunk, Y_chunk)
+
+    if stats is None:
+        raise ValueError('No data to fit')
+
+    return stats.fit(L = L, regress = regress, display_failures = display_failures, conservative = conservative)
+
+
+def iter_chunks(X, Y, chunk_size = 10000, svt = False):
+    '''
+    Yields (X_chunk, Y_chunk) blocks of chunk_size rows. X and Y are arrays or
+    paths to .npy files, which are memory-mapped rather than loaded. If svt
+    is True, Y is stored as components x frames (as SVTcorr.npy) and is
+    transposed block by block.
+    '''
+
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode='r')
+    if isinstance(Y, str):
+        Y = np.load(Y, mmap_mode='r')
+
+    n = np.size(X, 0)
+    if np.size(Y, 1 if svt else 0) != n:
+        raise ValueError('Size mismatch')
+
+    for start in range(0, n, chunk_size):
+        rows = slice(start, min(start + chunk_size, n))
+        yield X[rows] if issparse(X) else np.asarray(X[rows]), np.asarray(Y[:, rows].T if svt else Y[rows])
+
+
+@profiled('ridge_MML.lambda_search')
+def ridge_MML_all_Y(q, d2, n, Y_var, alpha2):
+
+    # Compute the lambdas for all columns of Y at once. This follows the same
+    # two-step search as the per-column ridge_MML_one_Y of the original port
+    # (legacy/ridge_MML.py), but every step is evaluated for all the columns
+    # that are still searching as one array operation.
 
     # Width of smoothing kernel to use when dealing with large lambda
-    
+
     smooth = 7
 
     # Value of lambda at which to switch from step size 1/4 to step size L/stepDenom.
-    # Value of stepSwitch must be >= smooth/4, and stepSwitch/stepDenom should
-    # be >= 1/4.
     step_switch = 25
     step_denom = 100
-    
+
+    pY = np.size(alpha2, 1)
+
+    L = np.full(pY, np.nan)
+    min_L = np.full(pY, np.nan)
+    max_L = np.full(pY, np.nan)
+    convergence_failures = np.zeros(pY, dtype=int)
+
+    ## Mint the negative log-likelihood function
+    NLL_func = mint_batch_NLL_func(q, d2, n, Y_var, alpha2)
+
     ## Set up smoothing
 
-    # These rolling buffers will hold the last few values, to average for smoothing
-    sm_buffer = np.full(smooth, np.nan)
+    # The rolling buffers are shared by all columns: the lambdas tested at each
+    # step are the same for every column, only the likelihoods differ
+    sm_buffer = np.full((smooth, pY), np.nan)
     test_vals_L = np.full(smooth, np.nan)
-
-    # Initialize index of the buffers where we'll write the next value
     sm_buffer_I = 0
-                
-    """
-    Evaluate the log likelihood of the data for increasing values of lambda
-    This is step 1 of the two-step algorithm at the bottom of page 6.
-    Basically, increment until we pass the peak. Here, I've added trying
-    small steps as normal, then switching over to using larger steps and
-    smoothing to combat local minima.
-    """
-    
-    ## Mint the negative log-likelihood function
-    NLL_func = mint_NLL_func(q, d2, n, Y_var, alpha2)
 
     # Loop through first few values of k before you apply smoothing.
     # Step size 1/4, as recommended by Karabatsos
 
-    done = False
-    NLL = np.inf
+    searching = np.ones(pY, dtype=bool)
+    NLL = np.full(pY, np.inf)
     for k in range(step_switch * 4+1):
         sm_buffer_I = sm_buffer_I % smooth +1
-        prev_NLL = NLL
-
-      # Compute negative log likelihood of the data for this value of lambda
-        NLL = NLL_func(k / 4)
-        
-      # Add to smoothing buffer
-        sm_buffer[int(sm_buffer_I-1)] = NLL
-        test_vals_L[int(sm_buffer_I-1)] = k / 4
-
-      # Check if we've passed the minimum
-        if NLL > prev_NLL:
-            # Compute limits for L
-            min_L = (k - 2) / 4
-            max_L = k / 4
-            done = True
+        cols = np.flatnonzero(searching)
+        prev_NLL = NLL[cols]
+
+        # Compute negative log likelihood of the data for this value of lambda
+        NLL[cols] = NLL_func(k / 4, cols)
+
+        # Add to smoothing buffer
+        sm_buffer[sm_buffer_I-1, cols] = NLL[cols]
+        test_vals_L[sm_buffer_I-1] = k / 4
+
+        # Check which columns have passed the minimum
+        passed = cols[NLL[cols] > prev_NLL]
+        min_L[passed] = (k - 2) / 4
+        max_L[passed] = k / 4
+        searching[passed] = False
+
+        if not searching.any():
             break
-                        
-            
-    """
-    If we haven't already hit the max likelihood, continue increasing lambda,
-    but now apply smoothing to try to reduce the impact of local minima that
-    occur when lambda is large
-    """
 
-    # Also increase step size from 1/4 to L/stepDenom, for speed and robustness
-    # to local minima
-    if not done:
-        
-        L = k / 4
-        NLL = np.mean(sm_buffer)
-        iteration = 0
-        
-        while not done:
-            L += L / step_denom
+    passed_min = ~searching
+
+    # If we haven't already hit the max likelihood, continue increasing lambda,
+    # but now apply smoothing to try to reduce the impact of local minima that
+    # occur when lambda is large
+
+    if searching.any():
+
+        c_L = k / 4
+        NLL = np.mean(sm_buffer, 0)
+
+        while searching.any():
+            c_L += c_L / step_denom
             sm_buffer_I = sm_buffer_I % smooth
-            prev_NLL = NLL
-            iteration += 1
+            cols = np.flatnonzero(searching)
+            prev_NLL = NLL[cols]
+
             # Compute negative log likelihood of the data for this value of lambda,
             # overwrite oldest value in the smoothing buffer
-            sm_buffer[int(sm_buffer_I)] = NLL_func(L)
-            test_vals_L[int(sm_buffer_I)] = L
-            NLL = np.mean(sm_buffer)
-            
+            sm_buffer[int(sm_buffer_I), cols] = NLL_func(c_L, cols)
+            test_vals_L[int(sm_buffer_I)] = c_L
+            NLL[cols] = np.mean(sm_buffer[:, cols], 0)
+
             # Check if we've passed the minimum or hit NaN NLL (L passed double-precision maximum)
-            
-            if NLL>prev_NLL:
+            passed = cols[NLL[cols] > prev_NLL]
+            failed = cols[~(NLL[cols] > prev_NLL) & np.isnan(NLL[cols])]
+
+            if passed.size > 0:
                 # Adjust for smoothing kernel (walk back by half the kernel)
-                sm_buffer_I -= (smooth - 1) / 2
-                sm_buffer_I += smooth * (sm_buffer_I < 0) # wrap around
-                
-        
-                max_L = test_vals_L[int(sm_buffer_I-1)]
-            
+                walk_I = sm_buffer_I - (smooth - 1) / 2
+                walk_I += smooth * (walk_I < 0) # wrap around
+                max_L[passed] = test_vals_L[int(walk_I-1)]
+
                 # Walk back by two more steps to find min bound
-                sm_buffer_I -= 2
-                sm_buffer_I += smooth * (sm_buffer_I < 0) # wrap around
-                min_L = test_vals_L[int(sm_buffer_I)]
-
-                passed_min = True
-                done = True
-                
-            elif np.isnan(NLL):
-                
-                passed_min = False
-                done = True
-                
-    else:
-        
-        passed_min = True
+                walk_I -= 2
+                walk_I += smooth * (walk_I < 0) # wrap around
+                min_L[passed] = test_vals_L[int(walk_I)]
+
+                passed_min[passed] = True
+
+            L[failed] = c_L
+            searching[passed] = False
+            searching[failed] = False
 
-                
     ## Bounded optimization of lambda
-    # This is step 2 of the two-step algorithm at the bottom of page 6. Note
-    # that Karabatsos made a mistake when describing the indexing relative to
-    # k*, which is fixed here (we need to go from k*-2 to k*, not k*-1 to k*+1)
-    
-    if passed_min:
-        L, _, flag, _ = optimize.fminbound(NLL_func, max(0, min_L), max_L, xtol=1e-04, full_output=1, disp=0)
-    else:
-        flag = 1 # if the above loop could not find the minimum, return failed-to-converge flag
-    
-    return L, flag
-
-
-def  mint_NLL_func(q, d2, n, Y_var, alpha2):
-    # Mint an anonymous function with L as the only input parameter, with all
-    # the other terms determined by the data.
-    # Equation 19 
-    # We've modified the math here to eliminate the d^2 term from both alpha
-    # (Equation 1, in main function) and here (Equation 19), because they
-    # cancel out and add numerical instability.
-    NLL_func = lambda L: - (q * np.log(L) - np.sum(np.log(L + d2[:q])) \
-                - n * np.log(Y_var - np.sum( np.divide(alpha2[:q],(L + d2[:q])))))
-    return NLL_func
\ No newline at end of file
+    # This is step 2 of the two-step algorithm at the bottom of page 6, run
+    # for all the columns that passed the minimum together.
+
+    cols = np.flatnonzero(passed_min)
+    if cols.size > 0:
+        L[cols], convergence_failures[cols] = fminbound_batch(NLL_func, np.maximum(0, min_L[cols]),
+                                                              max_L[cols], cols, xtol=1e-04)
+    convergence_failures[~passed_min] = 1 # if the above loop could not find the minimum, return failed-to-converge flag
+
+    count('lambda_columns', pY)
+    count('convergence_failures', np.sum(convergence_failures > 0))
+
+    return L, convergence_failures
+
+
+def mint_batch_NLL_func(q, d2, n, Y_var, alpha2):
+    # Mint a function of L (and of the columns of Y to evaluate) that computes
+    # Equation 19 for several columns of Y at once. L may be a single lambda
+    # shared by all columns, or one lambda per column.
+    d2 = d2[:q, np.newaxis]
+    alpha2 = alpha2[:q]
+
+    def NLL_func(L, cols):
+        count('nll_evaluations', np.size(cols)) # one per column
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if np.ndim(L) == 0:
+                log_det = np.sum(np.log(L + d2))
+                shrink = (1 / (L + d2)).T @ alpha2[:, cols]
+                shrink = shrink[0]
+            else:
+                log_det = np.sum(np.log(L + d2), 0)
+                shrink = np.sum(np.divide(alpha2[:, cols], (L + d2)), 0)
+            return - (q * np.log(L) - log_det - n * np.log(Y_var[cols] - shrink))
+
+    return NLL_func
+
+
+@profiled('ridge_MML.fminbound')
+def fminbound_batch(func, x1, x2, cols, xtol=1e-05, maxfun=500):
+    """
+    Bounded scalar minimization of several independent functions at once, using
+    the same golden-section / parabolic interpolation steps as
+    scipy.optimize.fminbound. func(x, cols) must return one value per column.
+
+    Returns the minimizers and a flag per column (0 = converged, 1 = maximum
+    number of function calls reached, 2 = NaN result), as in fminbound.
+    """
+
+    sqrt_eps = np.sqrt(2.2e-16)
+    golden_mean = 0.5 * (3.0 - np.sqrt(5.0))
+
+    a, b = np.array(x1, dtype=float), np.array(x2, dtype=float)
+    fulc = a + golden_mean * (b - a)
+    nfc, xf = fulc.copy(), fulc.copy()
+    rat = np.zeros_like(a)
+    e = np.zeros_like(a)
+    x = xf.copy()
+    fx = func(x, cols)
+    num = 1
+    count('fminbound_columns', np.size(cols))
+    fu = np.full_like(a, np.inf)
+    flag = np.zeros(np.size(a), dtype=int)
+
+    ffulc = fx.copy()
+    fnfc = fx.copy()
+    xm = 0.5 * (a + b)
+    tol1 = sqrt_eps * np.abs(xf) + xtol / 3.0
+    tol2 = 2.0 * tol1
+
+    active = np.abs(xf - xm) > (tol2 - 0.5 * (b - a))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while active.any():
+
+            # Check for parabolic fit
+            parabolic = np.abs(e) > tol1
+            r = (xf - nfc) * (fx - ffulc)
+            q = (xf - fulc) * (fx - fnfc)
+            p = (xf - fulc) * q - (xf - nfc) * r
+            q = 2.0 * (q - r)
+            p = np.where(q > 0.0, -p, p)
+            q = np.abs(q)
+            r = np.where(parabolic, e, r)
+            e = np.where(parabolic, rat, e)
+
+            # Check for acceptability of parabola
+            parabolic &= (np.abs(p) < np.abs(0.5 * q * r)) & (p > q * (a - xf)) & (p < q * (b - xf))
+            p_rat = p / q
+            x = xf + p_rat
+            si = np.sign(xm - xf) + ((xm - xf) == 0)
+            p_rat = np.where(((x - a) < tol2) | ((b - x) < tol2), tol1 * si, p_rat)
+
+            # Otherwise do a golden-section step
+            g_e = np.where(xf >= xm, a - xf, b - xf)
+            e = np.where(parabolic, e, g_e)
+            rat = np.where(parabolic, p_rat, golden_mean * g_e)
+
+            si = np.sign(rat) + (rat == 0)
+            x = xf + si * np.maximum(np.abs(rat), tol1)
+            fu[active] = func(x[active], cols[active])
+            num += 1
+            count('fminbound_iterations', np.sum(active)) # one per searching column
+
+            lower = fu <= fx
+            a_new = np.where(lower, np.where(x >= xf, xf, a), np.where(x < xf, x, a))
+            b_new = np.where(lower, np.where(x >= xf, b, xf), np.where(x < xf, b, x))
+
+            shift_nfc = ~lower & ((fu <= fnfc) | (nfc == xf))
+            set_fulc = ~lower & ~shift_nfc & ((fu <= ffulc) | (fulc == xf) | (fulc == nfc))
+
+            fulc_new = np.where(lower | shift_nfc, nfc, np.where(set_fulc, x, fulc))
+            ffulc_new = np.where(lower | shift_nfc, fnfc, np.where(set_fulc, fu, ffulc))
+            nfc_new = np.where(lower, xf, np.where(shift_nfc, x, nfc))
+            fnfc_new = np.where(lower, fx, np.where(shift_nfc, fu, fnfc))
+            xf_new = np.where(lower, x, xf)
+            fx_new = np.where(lower, fu, fx)
+
+            # Only update the columns that are still searching
+            a, b = np.where(active, a_new, a), np.where(active, b_new, b)
+            fulc, ffulc = np.where(active, fulc_new, fulc), np.where(active, ffulc_new, ffulc)
+            nfc, fnfc = np.where(active, nfc_new, nfc), np.where(active, fnfc_new, fnfc)
+            xf, fx = np.where(active, xf_new, xf), np.where(active, fx_new, fx)
+
+            xm = 0.5 * (a + b)
+            tol1 = sqrt_eps * np.abs(xf) + xtol / 3.0
+            tol2 = 2.0 * tol1
+
+            if num >= maxfun:
+                flag[active] = 1
+                break
+
+            active &= np.abs(xf - xm) > (tol2 - 0.5 * (b - a))
+
+    flag[np.isnan(xf) | np.isnan(fx) | np.isnan(fu)] = 2
+
+    return xf, flag
@@ -0,0 +1,144 @@
+# MIT License
+
+# Copyright (c) 2019 Churchland laboratory
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import uuid
+import weakref
+from multiprocessing import shared_memory, resource_tracker
+
+from .utils import *
+
+
+class SharedStack(object):
+
+    '''
+    Publishes the arrays of an SVDStack (U, SVT and mask) once, in shared
+    memory or, if scratch is a folder, in memory-mapped .npy files there.
+    Worker processes attach to them by name with attach_stack(handle),
+    without copying or pickling the arrays.
+
+    The arrays are released by close(), at the end of a with block, when
+    the SharedStack is garbage collected or when the interpreter exits. If
+    the process is killed, the resource tracker of multiprocessing still
+    unlinks the shared memory (scratch files are left in the folder).
+
+    Usage:
+    with SharedStack(r_stack) as shared:
+        pool.map(worker, [shared.handle] * n) # worker calls attach_stack(handle)
+    '''
+
+    def __init__(self, stack, scratch = None, chunk_size = 1000):
+
+        if stack.issparse:
+            raise ValueError('Sparse spatial components can not be shared')
+
+        arrays = {'U': stack.U, 'SVT': stack.SVT, 'mask': stack.mask}
+        self.handle = {'backend': 'shm' if scratch is None else 'file', 'dims': list(stack.shape[1:]), 'arrays': {}}
+        buffers, files = [], []
+        self._finalizer = weakref.finalize(self, release_shared, buffers, files) # registered first, so a failure below still cleans up
+
+        for key, a in arrays.items():
+            if scratch is None:
+                shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+                buffers.append(shm)
+                name = shm.name
+                view = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            else:
+                name = pjoin(scratch, f'ridgemodel_{os.getpid()}_{uuid.uuid4().hex}_{key}.npy')
+                files.append(name)
+                view = np.lib.format.open_memmap(name, mode='w+', dtype=a.dtype, shape=a.shape)
+
+            for start in range(0, max(len(a), 1), chunk_size): # copy in chunks, a may be memory-mapped
+                view[start:start + chunk_size] = a[start:start + chunk_size]
+            if scratch is not None:
+                view.flush()
+            del view # no views may be left on the buffers when they are closed
+
+            self.handle['arrays'][key] = (name, a.shape, a.dtype.str)
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def release_shared(buffers, files):
+    # close and unlink the shared memory and scratch files of a SharedStack
+
+    for shm in buffers:
+        try:
+            shm.close()
+        except BufferError: # still viewed in this process, the memory is freed when the views are
+            pass
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    for fname in files:
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+
+def open_shared(name):
+    # attach to shared memory without registering it with the resource tracker,
+    # so only the publishing process unlinks it (when it exits or is killed)
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None if rtype == 'shared_memory' else register(name, rtype)
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def attach_stack(handle, writable = False):
+
+    '''
+    SVDStack whose arrays are views of the ones published by a SharedStack
+    (see SharedStack.handle). The arrays are read-only unless writable is
+    True, in which case writes are seen by every process.
+    '''
+
+    arrays = {}
+    buffers = []
+    for key, (name, shape, dtype) in handle['arrays'].items():
+        if handle['backend'] == 'shm':
+            shm = open_shared(name)
+            buffers.append(shm)
+            arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arrays[key].flags.writeable = writable
+        else:
+            arrays[key] = np.load(name, mmap_mode='r+' if writable else 'r')
+
+    stack = SVDStack(arrays['U'], arrays['SVT'], dims = handle['dims'])
+    stack.mask = arrays['mask']
+    stack._buffers = buffers # keep the shared memory mapped while the stack is used
+
+    return stack
@@ -35,39 +35,244 @@ from scipy import optimize, io
 import scipy.stats as st
 from tqdm.notebook import tqdm, trange
 from .ridge import *
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 warnings.filterwarnings('ignore')
 import random
+import contextlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from .profiling import stage, count, profiled
+
+def blas_threads(n_threads):
+    # limit the number of BLAS threads inside a with block (needs threadpoolctl, otherwise does nothing)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=n_threads, user_api='blas')
+
+
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+_n_cpus = None
+
+def cpu_budget():
+    # number of CPUs this process may use: all of them, unless limit_cpus was called (e.g. in a batch worker process)
+    return _n_cpus or os.cpu_count()
+
+@contextlib.contextmanager
+def blas_env(n_threads):
+    # set the BLAS thread variables inside a with block, so that processes started in it load BLAS with n_threads threads
+    saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def limit_cpus(n_cpus):
+    # cap BLAS at n_cpus threads for the rest of the process. The thread pools
+    # of n_jobs then split n_cpus instead of all the CPUs of the machine.
+    # Without threadpoolctl, only the environment variables are set, which
+    # only take effect for BLAS libraries that are loaded afterwards.
+    global _n_cpus
+    _n_cpus = n_cpus
+    os.environ.update({var: str(n_cpus) for var in BLAS_THREAD_VARS})
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_cpus, user_api='blas')
+
+
+def reconstruct(u, svt, dims = None, out = None, mask = None, frame_chunk = 256, pixel_chunk = 65536, n_jobs = 1):
+
+    '''
+    Reconstructs frames (frames x H x W) from spatial components u (H x W x S,
+    or sparse pixels x S with dims = [H,W]) and temporal components svt
+    (S x frames).
+
+    Only the pixels outside mask (by default the NaN pixels of u) are
+    multiplied, in tiles of frame_chunk frames by pixel_chunk pixels, and
+    written into out (frames x H x W) if given, so no full-size
+    temporary is made. The tiles are spread over n_jobs threads.
+    '''
 
-def reconstruct(u,svt,dims = None):
     if issparse(u):
         if dims is None:
             raise ValueError('Supply dims = [H,W] when using sparse arrays')
+        valid = np.arange(np.prod(dims))
+        u_valid = u
     else:
         if dims is None:
             dims = u.shape[:2]
-    return u.dot(svt).reshape((*dims,-1)).transpose(-1,0,1).squeeze()
+        u = u.reshape(-1,u.shape[-1])
+        if mask is None:
+            mask = np.isnan(u[:,0])
+        valid = np.flatnonzero(~np.ravel(mask))
+        u_valid = u[valid]
+
+    return reconstruct_valid(u_valid, valid, svt, dims, out, frame_chunk, pixel_chunk, n_jobs)
+
+
+@profiled('reconstruct')
+def reconstruct_valid(u_valid, valid, svt, dims, out = None, frame_chunk = 256, pixel_chunk = 65536, n_jobs = 1):
+    # reconstruct from the spatial components of the valid (flat) pixels only, the other pixels are NaN
+
+    frames = np.size(svt,1)
+    if out is None:
+        out = np.empty((frames, *dims), dtype=np.result_type(u_valid.dtype, svt.dtype))
+        squeeze = True
+    else:
+        if out.shape != (frames, *dims) or not out.flags.c_contiguous:
+            raise ValueError(f'out must be a C-contiguous array of shape {(frames, *dims)}')
+        squeeze = False
+    out_flat = out.reshape(frames,-1)
+
+    if len(valid) < np.size(out_flat,1):
+        invalid = np.ones(np.size(out_flat,1), dtype=np.bool_)
+        invalid[valid] = False
+        out_flat[:, invalid] = np.nan
+
+    def fill_tile(f_start, p_start):
+        c_valid = valid[p_start:p_start + pixel_chunk]
+        tile = (u_valid[p_start:p_start + pixel_chunk] @ svt[:, f_start:f_start + frame_chunk]).T
+        if c_valid[-1] - c_valid[0] == len(c_valid) - 1: # contiguous pixels
+            out_flat[f_start:f_start + frame_chunk, c_valid[0]:c_valid[-1] + 1] = tile
+        else:
+            out_flat[f_start:f_start + frame_chunk, c_valid] = tile
+
+    tiles = [(f_start, p_start) for f_start in range(0, frames, frame_chunk) for p_start in range(0, len(valid), pixel_chunk)]
+
+    if n_jobs > 1:
+        with blas_threads(max(1, cpu_budget() // n_jobs)), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for job in [pool.submit(fill_tile, *tile) for tile in tiles]:
+                job.result()
+    else:
+        for tile in tiles:
+            fill_tile(*tile)
+
+    return out.squeeze() if squeeze else out
     
     
+def as_float32(a, chunk_size = 1000):
+    # float32 version of an array, converted in chunks along the first axis (no copy if it already is float32)
+
+    if issparse(a):
+        return a.astype('float32', copy=False)
+    if a.dtype == np.float32:
+        return a
+
+    out = np.empty(a.shape, dtype=np.float32)
+    for start in range(0, len(a), chunk_size):
+        out[start:start + chunk_size] = a[start:start + chunk_size]
+
+    return out
+
+
+class FrameCache(object):
+
+    '''
+    Least-recently-used cache of reconstructed frames, bounded by max_bytes.
+    hits and misses count the frames that were (not) found in the cache.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, i_frame):
+        frame = self.frames.get(i_frame)
+        if frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.frames.move_to_end(i_frame)
+        return frame
+
+    def put(self, i_frame, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        self.invalidate([i_frame])
+        self.frames[i_frame] = frame.copy()
+        self.nbytes += frame.nbytes
+        while self.nbytes > self.max_bytes: # evict the least recently used frames
+            self.nbytes -= self.frames.popitem(last=False)[1].nbytes
+
+    def invalidate(self, frame_idx = None):
+        # drop the frames in frame_idx (all frames by default)
+        if frame_idx is None:
+            self.frames.clear()
+            self.nbytes = 0
+            return
+        for i_frame in frame_idx:
+            frame = self.frames.pop(i_frame, None)
+            if frame is not None:
+                self.nbytes -= frame.nbytes
+
+
 class SVDStack(object):
 
+    '''
+    Widefield stack stored as spatial (U) and temporal (SVT) components.
+
+    Arrays that are already float32, including memory-mapped ones (see
+    load_stack), are used as they are, without a copy. U of another dtype is
+    only converted to float32, in chunks, when it is first used.
+
+    enable_cache(max_bytes) keeps the most recently reconstructed frames, so
+    indexing the same frames again does not recompute them.
+    '''
+
     def __init__(self, U, SVT, dims = None, dtype = 'float32'):
-        self.U = U.astype('float32')
-        self.SVT = SVT.astype('float32')
+        self._U = U
+        self.SVT = as_float32(SVT)
         self.issparse = False
         
         if issparse(U):
             self.issparse = True
             if dims is None:
                 raise ValueError('Supply dims = [H,W] when using sparse arrays')
-            self.Uflat = self.U
         else:
             if dims is None:
                 dims = U.shape[:2]
-            self.Uflat = self.U.reshape(-1,self.U.shape[-1])
         self.shape = [SVT.shape[1],*dims]
         self.dtype = dtype
         self.mask = np.isnan(U[:,:,0]) # create the mask
+        self.cache = None
+
+    def enable_cache(self, max_bytes = 2**30):
+        self.cache = FrameCache(max_bytes)
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    @property
+    def U(self):
+        self._U = as_float32(self._U) # convert on first use
+        return self._U
+
+    @property
+    def Uflat(self):
+        if self.issparse:
+            return self.U
+        return self.U.reshape(-1,self.U.shape[-1])
+
+    def model_stack(self):
+        # stack with the same spatial components and zeroed temporal components, for the modeled data
+        self.U # convert once and share it
+        m_stack = copy.copy(self)
+        m_stack.SVT = np.zeros(self.SVT.shape, dtype=np.float32) # zero pages are only allocated once written
+        m_stack.cache = None
+        return m_stack
         
             
     def split(self, folds):
@@ -77,21 +282,52 @@ class SVDStack(object):
             
         rng = np.random.default_rng(1) # for reproducibility
         rand_idx = rng.permutation(len(self)) # generate randum number index for splitting training and testing
-        fold_cnt = np.floor(len(self) / folds).astype(np.uint)       
+        fold_cnt = int(np.floor(len(self) / folds))
         
         for i_fold in range(folds):
             train_idx = np.ones(len(self),dtype=np.bool_)
             train_idx[rand_idx[(i_fold*fold_cnt) + np.arange(fold_cnt)]] = False # indexes for training data
 
             yield i_fold, train_idx # yield successive training folds and their indices
-        
-    def train(self, train_idx, cR, c_ridge = None, suppress_output = False):
-        
+
+    def split_stats(self, folds, cR):
+
+        # Same folds as split, but also yields the cross products of each
+        # training set. These are computed in one pass over the data, from
+        # the statistics of every held-out block: training = total - block.
+
+        splits = list(self.split(folds))
+
+        with stage('cross_products'):
+            blocks = [GramStats.from_data(cR[~train_idx,:], self.SVT[:,~train_idx].T) for _, train_idx in splits]
+
+            in_block = np.zeros(len(self), dtype=np.bool_)
+            for _, train_idx in splits:
+                in_block |= ~train_idx
+            total = GramStats.from_data(cR[~in_block,:], self.SVT[:,~in_block].T) # frames that are never held out
+            for block in blocks:
+                total.merge(block)
+
+        for (i_fold, train_idx), block in zip(splits, blocks):
+            yield i_fold, train_idx, total.subtract(block)
+
+    @profiled('SVDStack.train')
+    def train(self, train_idx, cR, c_ridge = None, suppress_output = False, stats = None):
+
+        if stats is not None: # fit from precomputed cross products of the training set
+            return stats.fit(L = c_ridge, display_failures = not suppress_output)
+
         return ridge_MML(self.SVT[:,train_idx].T, cR[train_idx,:], recenter = True, L = c_ridge, display_failures = not suppress_output)            
     
-    def test(self, train_idx, cR, c_beta):
+    def test(self, train_idx, cR, c_beta, c_idx = None):
         
-        self.SVT[:, ~train_idx] = (cR[~train_idx,:] @ c_beta).T
+        if c_idx is None:
+            self.SVT[:, ~train_idx] = (cR[~train_idx,:] @ c_beta).T
+        else: # only use the regressors in c_idx
+            self.SVT[:, ~train_idx] = (cR[~train_idx,:][:,c_idx] @ c_beta).T
+
+        if self.cache is not None: # the reconstructed test frames changed
+            self.cache.invalidate(np.flatnonzero(~train_idx))
         
     def __len__(self):
         return self.SVT.shape[1]
@@ -102,16 +338,64 @@ class SVDStack(object):
             idxz = range(*args[0].indices(self.shape[0]))
         else:
             idxz = args[0]        
-        return reconstruct(self.U,self.SVT[:,idxz],dims = self.shape[1:])
+        return self.frames(idxz)
+
+    def frames(self, idxz, out = None, n_jobs = 1):
+        # reconstruct the frames in idxz, optionally into out (float32, frames x H x W) and with n_jobs threads
+        if self.cache is None:
+            return self.reconstruct_svt(self.SVT[:,idxz], out, n_jobs)
+
+        frame_idx = np.atleast_1d(np.arange(self.shape[0])[idxz])
+        squeeze = out is None
+        if out is None:
+            out = np.empty((len(frame_idx), *self.shape[1:]), dtype=np.float32)
+
+        missing = []
+        for i, i_frame in enumerate(frame_idx):
+            frame = self.cache.get(i_frame)
+            if frame is None:
+                missing.append(i)
+            else:
+                out[i] = frame
+
+        if len(missing) == len(frame_idx):
+            self.reconstruct_svt(self.SVT[:,frame_idx], out, n_jobs)
+        elif missing:
+            out[missing] = self.reconstruct_svt(self.SVT[:,frame_idx[missing]], np.empty((len(missing), *self.shape[1:]), dtype=np.float32), n_jobs)
+        for i in missing:
+            self.cache.put(frame_idx[i], out[i])
+
+        return out.squeeze() if squeeze else out
+
+    def reconstruct_svt(self, svt, out = None, n_jobs = 1):
+        # reconstruct frames from temporal components svt (S x frames)
+        if svt.ndim == 1:
+            svt = svt[:,None]
+        if self.issparse:
+            return reconstruct(self.U, svt, dims = self.shape[1:], out = out, n_jobs = n_jobs)
+        return reconstruct_valid(self.U_valid, self.valid, svt, self.shape[1:], out = out, n_jobs = n_jobs)
+
+    @property
+    def U_valid(self):
+        # spatial components of the pixels outside the mask, compacted once
+        if getattr(self, '_U_valid', None) is None:
+            self.valid = np.flatnonzero(~self.mask.ravel())
+            self._U_valid = np.ascontiguousarray(self.Uflat[self.valid])
+        return self._U_valid
   
     
     
-def model_corr(r_stack, m_stack):
+@profiled('model_corr')
+def model_corr(r_stack, m_stack, chunk_size = 65536, n_jobs = 1):
     
     """
     short code to compute the correlation between lowD data Vc and modeled
     lowD data Vm. Vc and Vm are temporal components, U is the spatial
     components. corr_mat is a the correlation between Vc and Vm in each pixel.
+
+    The S x S covariances are accumulated over chunks of frames, and the
+    pixels are processed in float32 chunks of chunk_size (optionally on
+    n_jobs threads), so memory use is O(chunk_size * S) instead of P x S.
     
     Originally written in MATLAB by Simon Musall, 2019
     
@@ -120,15 +404,33 @@ def model_corr(r_stack, m_stack):
     
     Vc = np.reshape(r_stack.SVT,(np.size(r_stack.SVT,0),-1))
     Vm = np.reshape(m_stack.SVT,(np.size(m_stack.SVT,0),-1))
-    if len(np.shape(r_stack.U)) == 3:
-        U = array_shrink(r_stack.U, r_stack.mask)
-
-    cov_Vc = np.cov(Vc) # S x S
-    cov_Vm = np.cov(Vm) # % S x S
-    c_cov_V = (Vm - np.expand_dims(np.mean(Vm,1), axis=1)) @ Vc.T / (np.size(Vc, 1) - 1) # S x S
-    cov_P = np.expand_dims(np.sum((U @ c_cov_V) * U, 1),axis=0) # 1 x P
-    var_P1 = np.expand_dims(np.sum((U @ cov_Vc) * U, 1),axis=0) # 1 x Pii
-    var_P2 = np.expand_dims(np.sum((U @ cov_Vm) * U, 1),axis=0) # 1 x P
+
+    cov_Vc, cov_Vm, c_cov_V = stream_cov(Vc, Vm) # S x S
+    cov_Vc, cov_Vm, c_cov_V = cov_Vc.astype(np.float32), cov_Vm.astype(np.float32), c_cov_V.astype(np.float32)
+
+    valid = np.flatnonzero(~r_stack.mask.ravel())
+    cov_P = np.empty((1,len(valid)), dtype=np.float32) # 1 x P
+    var_P1 = np.empty((1,len(valid)), dtype=np.float32) # 1 x P
+    var_P2 = np.empty((1,len(valid)), dtype=np.float32) # 1 x P
+
+    def pixel_chunk(start):
+        if getattr(r_stack, '_U_valid', None) is not None: # already compacted
+            U = r_stack.U_valid[start:start + chunk_size]
+        else:
+            U = r_stack.Uflat[valid[start:start + chunk_size]]
+            U = U.toarray() if issparse(U) else np.asarray(U, dtype=np.float32)
+        cov_P[0, start:start + chunk_size] = np.einsum('ij,ij->i', U @ c_cov_V, U)
+        var_P1[0, start:start + chunk_size] = np.einsum('ij,ij->i', U @ cov_Vc, U)
+        var_P2[0, start:start + chunk_size] = np.einsum('ij,ij->i', U @ cov_Vm, U)
+
+    if n_jobs > 1:
+        with blas_threads(max(1, cpu_budget() // n_jobs)), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for job in [pool.submit(pixel_chunk, start) for start in range(0, len(valid), chunk_size)]:
+                job.result()
+    else:
+        for start in range(0, len(valid), chunk_size):
+            pixel_chunk(start)
+
     std_Px_Py = var_P1 ** 0.5 * var_P2 ** 0.5 # 1 x P
     corr_mat = (cov_P / std_Px_Py).T
     corr_mat = array_shrink(corr_mat,r_stack.mask,'split')
@@ -136,6 +438,66 @@ def model_corr(r_stack, m_stack):
     return corr_mat, var_P1, var_P2
 
 
+@profiled('parcel_corr')
+def parcel_corr(r_stack, m_stack, labels, chunk_size = 65536):
+
+    '''
+    Area-level version of model_corr. labels is an image (H x W, aligned to
+    U) of integer parcel IDs, with 0 for pixels outside any parcel. The
+    spatial components of each parcel are averaged into one set of weights
+    (k x S), so the variance and correlation of the mean activity of each
+    area are computed in SVD space, without reconstructing any pixels.
+
+    Returns a table (dict of arrays, one entry per parcel) with the parcel
+    label, its number of (unmasked) pixels, the correlation and cvR^2 of
+    the data and the model and their variances.
+    '''
+
+    labels = np.ravel(labels)
+    valid = np.flatnonzero(~r_stack.mask.ravel() & (labels != 0))
+    parcels, parcel_idx, n_pixels = np.unique(labels[valid], return_inverse=True, return_counts=True)
+
+    W = np.zeros((len(parcels), np.size(r_stack.SVT,0))) # k x S
+    for start in range(0, len(valid), chunk_size):
+        U = r_stack.Uflat[valid[start:start + chunk_size]]
+        U = U.toarray() if issparse(U) else np.asarray(U, dtype=np.float64)
+        c_idx = parcel_idx[start:start + chunk_size]
+        W += csr_matrix((np.ones(len(c_idx)), (c_idx, np.arange(len(c_idx)))), shape=(len(parcels), len(c_idx))) @ U # sum over the pixels of each parcel
+    W /= n_pixels[:,None]
+
+    cov_Vc, cov_Vm, c_cov_V = stream_cov(r_stack.SVT, m_stack.SVT)
+    var_data = np.einsum('ij,jk,ik->i', W, cov_Vc, W)
+    var_model = np.einsum('ij,jk,ik->i', W, cov_Vm, W)
+    corr = np.einsum('ij,jk,ik->i', W, c_cov_V, W) / np.sqrt(var_data * var_model)
+
+    return {'label': parcels, 'n_pixels': n_pixels, 'corr': corr, 'cvR2': corr ** 2, 'var_data': var_data, 'var_model': var_model}
+
+
+def stream_cov(Vc, Vm, chunk_size = 10000):
+    # covariance of Vc, of Vm and between Vm and Vc (S x S each), accumulated in float64 over chunks of frames
+
+    frames = np.size(Vc,1)
+    mean_c = np.zeros(np.size(Vc,0))
+    mean_m = np.zeros(np.size(Vm,0))
+    for start in range(0, frames, chunk_size):
+        mean_c += np.sum(Vc[:, start:start + chunk_size], 1, dtype=np.float64)
+        mean_m += np.sum(Vm[:, start:start + chunk_size], 1, dtype=np.float64)
+    mean_c /= frames
+    mean_m /= frames
+
+    cov_Vc = np.zeros((np.size(Vc,0), np.size(Vc,0)))
+    cov_Vm = np.zeros((np.size(Vm,0), np.size(Vm,0)))
+    c_cov_V = np.zeros((np.size(Vm,0), np.size(Vc,0)))
+    for start in range(0, frames, chunk_size):
+        c_Vc = Vc[:, start:start + chunk_size] - mean_c[:,None]
+        c_Vm = Vm[:, start:start + chunk_size] - mean_m[:,None]
+        cov_Vc += c_Vc @ c_Vc.T
+        cov_Vm += c_Vm @ c_Vm.T
+        c_cov_V += c_Vm @ c_Vc.T
+
+    return cov_Vc / (frames - 1), cov_Vm / (frames - 1), c_cov_V / (frames - 1)
+
+
 def array_shrink(data_in, mask, mode='merge'):
 
     """
@@ -199,14 +561,12 @@ def array_shrink(data_in, mask, mode='merge'):
 
     return data_out
 
-def cross_val_model(full_R, r_stack, c_labels, reg_idx, reg_labels, folds, suppress_output=False):
+def regressor_subset(c_labels, reg_idx, reg_labels):
 
     '''
-    This function computed the cross-validated R^2.
-    
-    Originally written in MATLAB by Simon Musall, 2019
-    
-    Adapted to Python by Michael Sokoletsky, 2021
+    Finds the columns of the design matrix that belong to the regressors in
+    c_labels. Returns the column index, the regressor index of these columns
+    and the labels in the order of the design matrix.
     '''
 
     labels_idx = np.nonzero(np.isin(reg_labels, c_labels))
@@ -220,24 +580,219 @@ def cross_val_model(full_R, r_stack, c_labels, reg_idx, reg_labels, folds, suppr
     for x, x_idx in enumerate(temp):
         sub_idx[sub_idx == x] = x_idx
 
+    return c_idx, sub_idx, c_labels
+
+
+@profiled('cross_val_model')
+def cross_val_model(full_R, r_stack, c_labels, reg_idx, reg_labels, folds, suppress_output=False, gram=False, n_jobs=1, checkpoint=None, checkpoint_key=None):
+
+    '''
+    This function computed the cross-validated R^2.
+
+    If gram is True, the cross products of every held-out block are computed
+    once and each fold is fit from the total minus its block, instead of
+    refitting each training set from the data.
+
+    Only the first fold searches for the ridge values. If n_jobs > 1, the
+    remaining folds are fit on a pool of n_jobs threads, which share the
+    design matrix and the stack, with the BLAS threads split between them.
+
+    If checkpoint is a folder, the ridge values and the betas and modeled
+    test frames of every fold are saved there as each fold completes. A
+    later call with the same checkpoint folder loads the completed folds and
+    only fits the remaining ones, with the same results. Every fold stores
+    checkpoint_key, and folds with a different key are fit again. By
+    default the key is fold_fingerprint of the data, so folds are never
+    resumed after the design matrix, the stack or gram changed.
+    
+    Originally written in MATLAB by Simon Musall, 2019
+    
+    Adapted to Python by Michael Sokoletsky, 2021
+    '''
+
+    c_idx, sub_idx, c_labels = regressor_subset(c_labels, reg_idx, reg_labels)
+
     cR = full_R[:,c_idx]
     
-    m_stack = SVDStack(r_stack.U, np.zeros_like(r_stack.SVT)) # pre-allocate modeled stack
+    m_stack = r_stack.model_stack() # pre-allocate modeled stack
 
     c_beta = [0]*folds
+    c_ridge = None
     
-    folds_gen = r_stack.split(folds) # split the real stack into folds for training the model
-    
-    for i_fold, train_idx in (tqdm(folds_gen, desc = 'Performing cross-validation', total=folds) if suppress_output==False else folds_gen): 
-      
-        if i_fold == 0:
-            c_ridge, c_beta[i_fold], _ = r_stack.train(train_idx, cR, suppress_output=suppress_output) # train the model on training indexes in current fold
-        else:
-            c_beta[i_fold] = r_stack.train(train_idx, cR, c_ridge) # train the model on training indexes in current fold. ridge value should be the same as in the first run.
+    if gram:
+        folds_gen = r_stack.split_stats(folds, cR) # split the real stack into folds and get the cross products of each training set
+    else:
+        folds_gen = ((i_fold, train_idx, None) for i_fold, train_idx in r_stack.split(folds)) # split the real stack into folds for training the model
 
+    if checkpoint is not None:
+        os.makedirs(checkpoint, exist_ok=True)
+        if checkpoint_key is None:
+            checkpoint_key = fold_fingerprint(cR, r_stack.SVT, gram)
+    
+    def finish_fold(i_fold, train_idx):
         m_stack.test(train_idx, cR, c_beta[i_fold]) # apply the model on the remaining (testing) indexes in the modeled stack
+        if checkpoint is not None:
+            save_fold(checkpoint, i_fold, checkpoint_key, c_idx, folds, c_beta[i_fold], m_stack.SVT[:, ~train_idx], c_ridge)
+
+    jobs = []
+
+    with contextlib.ExitStack() as parallel:
+
+        for i_fold, train_idx, stats in (tqdm(folds_gen, desc = 'Performing cross-validation', total=folds) if suppress_output==False else folds_gen): 
+
+            saved = load_fold(checkpoint, i_fold, checkpoint_key, c_idx, folds) if checkpoint is not None else None
+
+            if saved is not None: # completed in an earlier run
+                c_beta[i_fold] = saved['c_beta']
+                m_stack.SVT[:, ~train_idx] = saved['SVT']
+                if i_fold == 0:
+                    c_ridge = saved['c_ridge']
+
+            elif i_fold == 0:
+                c_ridge, c_beta[i_fold], _ = r_stack.train(train_idx, cR, suppress_output=suppress_output, stats=stats) # train the model on training indexes in current fold
+                finish_fold(i_fold, train_idx)
+
+            elif n_jobs > 1:
+                jobs.append((i_fold, train_idx, pool.submit(r_stack.train, train_idx, cR, c_ridge, stats=stats)))
+
+            else:
+                c_beta[i_fold] = r_stack.train(train_idx, cR, c_ridge, stats=stats) # train the model on training indexes in current fold. ridge value should be the same as in the first run.
+                finish_fold(i_fold, train_idx)
+
+            if i_fold == 0 and n_jobs > 1: # the ridge values are now fixed, so the remaining folds are independent
+                parallel.enter_context(blas_threads(max(1, cpu_budget() // n_jobs)))
+                pool = parallel.enter_context(ThreadPoolExecutor(max_workers=n_jobs))
+
+        for i_fold, train_idx, job in jobs:
+            c_beta[i_fold] = job.result()
+            finish_fold(i_fold, train_idx)
         
     return m_stack, c_beta, cR, sub_idx, c_ridge, c_labels
 
 
-    
\ No newline at end of file
+def fold_fingerprint(cR, SVT, gram = False):
+    # hash of the data a fold is fit on (shapes and contents of cR and SVT, and gram), to tell which checkpointed folds still apply
+    sha = hashlib.sha256(f'{cR.shape};{cR.dtype};{SVT.shape};{SVT.dtype};{bool(gram)};'.encode())
+    for array in ([cR.data, cR.indices, cR.indptr] if issparse(cR) else [cR]) + [SVT]:
+        sha.update(np.ascontiguousarray(array).data)
+    return sha.hexdigest()
+
+
+def save_fold(checkpoint, i_fold, key, c_idx, folds, c_beta, SVT, c_ridge = None):
+    # save the results of a fold, written to a temporary file first so a checkpoint is never partial
+    fname = pjoin(checkpoint, f'fold_{i_fold}.npz')
+    with open(fname + '.tmp', 'wb') as fold_f:
+        np.savez(fold_f, key=key, c_idx=c_idx, folds=folds, c_beta=c_beta, SVT=SVT, c_ridge=c_ridge if c_ridge is not None else np.nan)
+    os.replace(fname + '.tmp', fname)
+
+
+def load_fold(checkpoint, i_fold, key, c_idx, folds):
+    # results of a fold saved by save_fold, or None if the fold was not completed for this model and data
+    fname = pjoin(checkpoint, f'fold_{i_fold}.npz')
+    if not os.path.isfile(fname):
+        return None
+    with np.load(fname) as fold_f:
+        if 'key' not in fold_f.files or str(fold_f['key']) != key:
+            return None # fit on different data
+        if int(fold_f['folds']) != folds or not np.array_equal(fold_f['c_idx'], c_idx):
+            return None # from a different model
+        return {'c_beta': fold_f['c_beta'], 'SVT': fold_f['SVT'], 'c_ridge': fold_f['c_ridge']}
+
+
+@profiled('cross_val_models')
+def cross_val_models(full_R, r_stack, c_idxs, folds, suppress_output=False, n_jobs=1):
+
+    '''
+    Computes the cross-validated models of several subsets of the regressors
+    at once. c_idxs is a list of column masks of full_R (e.g. from
+    regressor_subset). The cross products of full_R are computed once per
+    held-out block, and every model is fit from its sub-block, so the data
+    is only passed over once however many models there are. If n_jobs > 1,
+    the models of each fold are fit on a pool of n_jobs threads.
+
+    Returns the modeled stack, the betas of every fold and the ridge values
+    of each model, as cross_val_model does for a single model.
+    '''
+
+    m_stacks = [r_stack.model_stack() for _ in c_idxs] # pre-allocate modeled stacks
+    c_betas = [[0]*folds for _ in c_idxs]
+    c_ridges = [None]*len(c_idxs)
+
+    def fit_model(i_model, i_fold, train_idx, stats):
+
+        c_stats = stats.subset(c_idxs[i_model])
+
+        if i_fold == 0:
+            c_ridges[i_model], c_betas[i_model][i_fold], _ = r_stack.train(train_idx, None, suppress_output=suppress_output, stats=c_stats)
+        else:
+            c_betas[i_model][i_fold] = r_stack.train(train_idx, None, c_ridges[i_model], stats=c_stats) # ridge value should be the same as in the first run.
+
+        m_stacks[i_model].test(train_idx, full_R, c_betas[i_model][i_fold], c_idxs[i_model])
+
+    folds_gen = r_stack.split_stats(folds, full_R) # split the real stack into folds and get the cross products of each training set
+
+    with contextlib.ExitStack() as parallel:
+
+        if n_jobs > 1:
+            parallel.enter_context(blas_threads(max(1, cpu_budget() // n_jobs)))
+            pool = parallel.enter_context(ThreadPoolExecutor(max_workers=n_jobs))
+
+        for i_fold, train_idx, stats in (tqdm(folds_gen, desc = 'Performing cross-validation', total=folds) if suppress_output==False else folds_gen):
+
+            if n_jobs > 1:
+                jobs = [pool.submit(fit_model, i_model, i_fold, train_idx, stats) for i_model in range(len(c_idxs))]
+                for job in jobs:
+                    job.result()
+            else:
+                for i_model in range(len(c_idxs)):
+                    fit_model(i_model, i_fold, train_idx, stats)
+
+    return m_stacks, c_betas, c_ridges
+
+
+@profiled('cross_val_unique')
+def cross_val_unique(full_R, r_stack, reg_idx, reg_labels, folds, c_labels=None, suppress_output=False):
+
+    '''
+    Computes the unique contribution of each regressor (delta R^2): the
+    cross-validated R^2 of the model with all regressors in c_labels (all
+    regressors by default) minus that of the model that leaves the regressor
+    out.
+
+    The reduced models are not refit. In every fold they are derived from
+    the full model with a block-inverse update (see ridge_drop_groups),
+    keeping the ridge values of the full model.
+
+    Returns the cvR^2 map of the full model, the delta R^2 map of each
+    regressor, the regressor labels, the ridge values and the modeled stack
+    of the full model.
+    '''
+
+    if c_labels is None:
+        c_labels = reg_labels
+
+    c_idx, sub_idx, c_labels = regressor_subset(c_labels, reg_idx, reg_labels)
+    c_labels = np.ravel(c_labels)
+    cR = full_R[:,c_idx]
+    groups = [reg_idx[c_idx] == np.nonzero(reg_labels == label)[0][0] for label in c_labels] # columns of each regressor
+
+    m_stack = r_stack.model_stack() # pre-allocate modeled stacks
+    r_stacks = [r_stack.model_stack() for _ in groups]
+
+    folds_gen = r_stack.split_stats(folds, cR) # split the real stack into folds and get the cross products of each training set
+
+    for i_fold, train_idx, stats in (tqdm(folds_gen, desc = 'Computing unique contributions', total=folds) if suppress_output==False else folds_gen):
+
+        if i_fold == 0:
+            c_ridge = stats.fit(regress=False, display_failures=not suppress_output)[0] # ridge values of the full model
+
+        c_beta, r_betas = stats.fit_drop_groups(c_ridge, groups)
+
+        m_stack.test(train_idx, cR, c_beta)
+        for c_stack, r_beta in zip(r_stacks, r_betas):
+            c_stack.test(train_idx, cR, r_beta)
+
+    cvR2 = model_corr(r_stack, m_stack)[0] ** 2
+    dR2 = np.stack([cvR2 - model_corr(r_stack, c_stack)[0] ** 2 for c_stack in r_stacks])
+
+    return cvR2, dR2, c_labels, c_ridge, m_stack